@@ -0,0 +1,80 @@
+"""
+Benchmark the in-memory readme chunker (webapp/chunking.py) against the previous path: readme doubled with a
+whitespace collapsed copy, written to a temp file, loaded with UnstructuredMarkdownLoader and split with
+CharacterTextSplitter. The previous path needs `pip install unstructured==0.11.8 langchain==0.1.0`, it is
+skipped when they are missing.
+
+Usage: python benchmarks/bench_chunking.py [README.md ...]
+Without files a synthetic readme with badges, html, code blocks and long sections is used.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webapp'))
+import chunking  # noqa: E402
+
+SAMPLE = """# Project
+[![Build](https://img.shields.io/badge/build-passing-green.svg)](https://ci.example.com)
+[![License](https://img.shields.io/badge/license-MIT-blue.svg)](LICENSE)
+<p align="center"><img src="logo.png" width="200"></p>
+
+Project is a fast, embeddable engine for doing useful things with data. It supports many formats and
+scales from a laptop to a cluster.
+
+## Installation
+```bash
+pip install project
+```
+
+## Usage
+""" + "\n\n".join(f"Paragraph {i} explains a feature of the project in some detail, with [links](https://x.y/{i}) "
+                  "and `inline code`, so that the readme looks like the real thing. " * 3 for i in range(40)) + """
+
+## License
+MIT
+"""
+
+
+def legacy_chunks(readme):
+    from langchain.text_splitter import CharacterTextSplitter
+    from langchain_community.document_loaders import UnstructuredMarkdownLoader
+
+    readme += ' '.join(readme.split())
+    path = os.path.join(tempfile.gettempdir(), 'bench-readme.md')
+    with open(path, 'w') as f:
+        f.write(readme)
+    documents = UnstructuredMarkdownLoader(path).load()
+    docs = CharacterTextSplitter(chunk_size=1000, chunk_overlap=50).split_documents(documents)
+    os.remove(path)
+    return [_.page_content for _ in docs]
+
+
+def bench(fn, readmes, rounds=3):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        chunks = [fn(readme) for readme in readmes]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, sum(len(c) for c in chunks), sum(len(t) for c in chunks for t in c)
+
+
+def main():
+    readmes = [open(path, encoding='utf-8').read() for path in sys.argv[1:]] or [SAMPLE] * 20
+    size = sum(len(r) for r in readmes) / 1e6
+    print(f"{len(readmes)} readmes, {size:.2f} MB")
+    elapsed, chunks, chars = bench(chunking.chunk_markdown, readmes)
+    print(f"in-memory:    {size / elapsed:8.2f} MB/s, {chunks} chunks, {chars} chars to embed")
+    try:
+        import unstructured  # noqa: F401
+    except ImportError:
+        print("unstructured not installed, skipping the previous path")
+        return
+    elapsed, chunks, chars = bench(legacy_chunks, readmes, rounds=1)
+    print(f"unstructured: {size / elapsed:8.2f} MB/s, {chunks} chunks, {chars} chars to embed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark the GH Archive parsing of func_utils.retrieve_repos against the previous implementation
+(json decode of every line, sort of the whole count dict) on a local archive.
+
+Usage: python benchmarks/bench_retrieve_repos.py [archive.json.gz]
+Without an archive a synthetic one is generated, a real one can be downloaded from
+https://data.gharchive.org/2024-01-01-15.json.gz
+"""
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'func'))
+import func_utils  # noqa: E402
+
+EVENT_TYPES = ['PushEvent', 'CreateEvent', 'IssueCommentEvent', 'WatchEvent', 'PullRequestEvent', 'ForkEvent',
+               'IssuesEvent', 'DeleteEvent', 'PullRequestReviewEvent']
+
+
+def make_sample_archive(path, events=200000, repos=20000, seed=0):
+    rnd = random.Random(seed)
+    with gzip.open(path, 'wt') as f:
+        for i in range(events):
+            event_type = rnd.choices(EVENT_TYPES, weights=[50, 10, 8, 6, 6, 3, 4, 3, 3])[0]
+            payload = {'action': rnd.choice(['opened', 'closed', 'reopened'])} if event_type == 'PullRequestEvent' else {}
+            payload['body'] = 'x' * rnd.randint(0, 2000)
+            event = {'id': str(i), 'type': event_type, 'public': True, 'payload': payload,
+                     'repo': {'id': i, 'name': f"owner{int(repos * rnd.random() ** 3)}/repo"},
+                     'actor': {'id': i, 'login': f'user{i}'}, 'created_at': '2024-01-01T15:00:00Z'}
+            f.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+
+def legacy_retrieve(path):
+    repos = {}
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            data = json.loads(line)
+            if data['public'] and ((data['type'] == "PullRequestEvent" and data['payload']['action'] == 'closed')
+                                   or (data['type'] == 'WatchEvent')):
+                repo = data['repo']['name']
+                if repo not in repos:
+                    repos[repo] = 0
+                repos[repo] += 1
+    repos = [k for k, v in sorted(repos.items(), key=lambda item: -item[1])]
+    return repos[:2000]
+
+
+def streaming_retrieve(path):
+    with gzip.open(path, 'rb') as f:
+        return func_utils.top_repos(func_utils.count_repo_events(f))
+
+
+def bench(fn, path, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        res = fn(path)
+        timings.append(time.perf_counter() - start)
+    return res, min(timings)
+
+
+def main():
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        path = os.path.join(tempfile.gettempdir(), 'gharchive-sample.json.gz')
+        if not os.path.exists(path):
+            print(f"Generating sample archive {path}...")
+            make_sample_archive(path)
+    size = os.path.getsize(path)
+    legacy, legacy_time = bench(legacy_retrieve, path, 3)
+    streaming, streaming_time = bench(streaming_retrieve, path, 3)
+    print(f"archive: {path} ({size / 1e6:.1f} MB compressed)")
+    print(f"legacy:    {legacy_time:.3f}s, {len(legacy)} repos")
+    print(f"streaming: {streaming_time:.3f}s, {len(streaming)} repos, {legacy_time / streaming_time:.1f}x faster")
+    print(f"same ranking: {legacy == streaming}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+End to end benchmark of the webapp and the function against local stand-ins (benchmarks/fakes.py): fake GitHub
+and OpenAI servers and a scratch Postgres + pgvector database. Reports throughput and p50/p95/p99 latencies of:
+- ingest: ingest.load_repos batches of fresh repos, then the same repos again (unchanged, incremental path)
+- summarize: GET /api/summarize and POST /api/summarize/batch
+- search: GET /api/search and /api/search/stream with distinct questions
+- archive: func_utils.retrieve_repos on a recorded GH Archive file served over http
+
+Usage: python benchmarks/bench_service.py [--repos 500] [--searches 50] [--archive archive.json.gz] ...
+Needs the webapp requirements and either BENCH_PG_HOST (and BENCH_PG_PORT/USER/PASSWORD) pointing to a
+Postgres server with pgvector, or docker. Without --archive the synthetic archive of bench_retrieve_repos is used.
+"""
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'webapp'))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'func'))
+import fakes  # noqa: E402
+
+
+def report(name, timings, elapsed):
+    """Print the throughput and latency percentiles of `timings` (seconds) measured over `elapsed` seconds."""
+    if len(timings) > 1:
+        cuts = statistics.quantiles(timings, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = timings[0]
+    print(f"{name:<24} n={len(timings):<6} {len(timings) / elapsed:9.1f}/s   "
+          f"p50={p50 * 1000:8.1f}ms  p95={p95 * 1000:8.1f}ms  p99={p99 * 1000:8.1f}ms")
+
+
+def run(fn, items, concurrency):
+    """Call `fn` on each item with `concurrency` threads, returns the per call timings and the elapsed time."""
+    def timed(item):
+        start = time.perf_counter()
+        fn(item)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        timings = list(pool.map(timed, items))
+    return timings, time.perf_counter() - start
+
+
+def configure(github, openai, database):
+    """The webapp and function settings pointing to the stand-ins, set before they are imported."""
+    os.environ.update(database.env)
+    os.environ.update({
+        'GITHUB_USERNAME': 'bench', 'GITHUB_TOKEN': 'bench',
+        'GITHUB_API_URL': github.url, 'GITHUB_RAW_URL': github.url,
+        'OPENAI_API_TYPE': 'azure', 'OPENAI_API_KEY': 'bench', 'OPENAI_API_VERSION': '2023-05-15',
+        'OPENAI_AZURE_ENDPOINT': openai.url, 'OPENAI_MODEL': 'gpt',
+        'HTTP_CACHE_DIR': tempfile.mkdtemp(prefix='githubmeta-bench-http-'),
+        'INGEST_WORKERS': '0',
+        'ARCHIVE_URL': github.url + '/gharchive/{year}-{month:02d}-{day:02d}-{hour}.json.gz',
+    })
+
+
+def bench_ingest(args):
+    import ingest
+    names = [f'owner{i}/repo{i}' for i in range(args.repos)]
+    batches = [names[i:i + args.batch] for i in range(0, len(names), args.batch)]
+    for label in ['ingest (new)', 'ingest (unchanged)']:
+        timings, elapsed = run(ingest.load_repos, batches, 1)
+        report(f'{label} batch', timings, elapsed)
+        print(f"{'':<24} {args.repos / elapsed:.1f} repos/s")
+
+
+def bench_summarize(client, args):
+    names = [f'owner{i}/repo{i}' for i in range(args.repos)]
+    report('summarize', *run(lambda name: client().get(f'/api/summarize?repo={name}'), names, args.concurrency))
+    batches = [names[i:i + 50] for i in range(0, len(names), 50)]
+    report('summarize batch of 50', *run(lambda batch: client().post('/api/summarize/batch', json={'items': batch}),
+                                         batches, args.concurrency))
+
+
+def bench_search(client, args):
+    def search(i):
+        response = client().get(f'/api/search?question=Which repos about topic {i} have the most stars?')
+        assert response.status_code == 200, response.status_code
+
+    def search_stream(i):
+        response = client().get(f'/api/search/stream?question=Which repos about subject {i} have the most stars?')
+        response.get_data()
+
+    report('search', *run(search, range(args.searches), args.concurrency))
+    report('search stream', *run(search_stream, range(args.searches), args.concurrency))
+
+
+def bench_archive(args):
+    import func_utils
+    hour = datetime.datetime(2024, 1, 1, 15)
+    timings, elapsed = run(lambda _: func_utils.retrieve_repos(hour.year, hour.month, hour.day, hour.hour),
+                           range(args.archive_rounds), 1)
+    report('archive retrieve_repos', timings, elapsed)
+    print(f"{'':<24} {os.path.getsize(args.archive) / 1e6 / min(timings):.1f} MB/s compressed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repos', type=int, default=500)
+    parser.add_argument('--batch', type=int, default=50, help='repos per ingest batch')
+    parser.add_argument('--searches', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--github-latency', type=float, default=0.05, help='seconds added to each GitHub request')
+    parser.add_argument('--github-rate-limit', type=int, default=100000, help='X-RateLimit-Limit of the fake')
+    parser.add_argument('--openai-latency', type=float, default=0.3, help='seconds added to each OpenAI request')
+    parser.add_argument('--openai-token-latency', type=float, default=0.01, help='seconds per streamed chunk')
+    parser.add_argument('--archive', help='recorded GH Archive file (.json.gz)')
+    parser.add_argument('--archive-rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    github = fakes.FakeGithub(repos=args.repos, latency=args.github_latency,
+                              rate_limit=args.github_rate_limit).start()
+    openai = fakes.FakeOpenai(latency=args.openai_latency, token_latency=args.openai_token_latency).start()
+    with fakes.Postgres() as database:
+        # The webapp and func_utils read their settings on import.
+        configure(github, openai, database)
+        if args.archive is None:
+            import bench_retrieve_repos
+            args.archive = os.path.join(tempfile.gettempdir(), 'gharchive-sample.json.gz')
+            if not os.path.exists(args.archive):
+                print(f"Generating sample archive {args.archive}...")
+                bench_retrieve_repos.make_sample_archive(args.archive)
+        github.archive = args.archive
+        import app
+        app.utils.init_db()
+        app.startup()
+        app.limiter.enabled = False
+        client = app.app.test_client
+
+        bench_ingest(args)
+        bench_summarize(client, args)
+        bench_search(client, args)
+        bench_archive(args)
+        print(f"requests served: github={github.requests} openai={openai.requests}")
+        app.utils.get_pool().closeall()
+    github.stop()
+    openai.stop()
+
+
+if __name__ == '__main__':
+    main()
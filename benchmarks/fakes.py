@@ -0,0 +1,287 @@
+"""
+Local stand-ins for the services the webapp and the function talk to, for repeatable benchmarks:
+- FakeGithub: the GitHub REST API (repos, languages, contributors), raw.githubusercontent.com readmes and
+  GH Archive files, with ETags, rate limit headers and a configurable latency.
+- FakeOpenai: the Azure OpenAI chat completion (plain and streamed) and embedding deployments, with canned
+  answers, deterministic embeddings and a configurable latency.
+- Postgres: a scratch Postgres + pgvector database, on the server given by BENCH_PG_* or in a docker container.
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+README = """# {name}
+[![Build](https://img.shields.io/badge/build-passing-green.svg)](https://ci.example.com)
+
+{name} is a {language} library for {topic}. It is fast, well tested and used in production by many teams.
+
+## Installation
+```bash
+pip install {name}
+```
+
+## Usage
+Import the package and call `run()` with your configuration. See the documentation for the full list of
+options, the examples folder has complete programs for the common {topic} tasks.
+
+## Contributing
+Pull requests are welcome. For major changes, please open an issue first to discuss what you would like to change.
+"""
+
+LANGUAGES = ['Python', 'JavaScript', 'Go', 'Rust', 'Java', 'TypeScript', 'C++']
+TOPICS = ['machine learning', 'web development', 'databases', 'data visualization', 'networking', 'testing']
+
+SEARCH_SQL = "<SELECT full_name, stargazers_count, language FROM repos ORDER BY stargazers_count DESC LIMIT 10>"
+EXPLANATION = ("These are the most starred repositories loaded so far, the first one has clearly more stars "
+               "than the others and most of them are libraries.")
+
+
+class _Server:
+    """A threading HTTP server run in a daemon thread, `url` is its base url."""
+
+    def __init__(self, handler):
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self.url = f'http://127.0.0.1:{self._httpd.server_address[1]}'
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+            return self.requests
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeGithub(_Server):
+    """
+    Serves `repos` synthetic repos named owner{i}/repo{i}. Every api response carries X-RateLimit headers
+    counting down from `rate_limit` per hour, responses have an ETag and `If-None-Match` is answered with 304.
+    `archive` is served for every GH Archive file requested under /gharchive/.
+    """
+
+    def __init__(self, repos=1000, latency=0.0, rate_limit=100000, archive=None, seed=0):
+        super().__init__(_GithubHandler)
+        self.repos = repos
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.archive = archive
+        self.seed = seed
+        self.reset_at = int(time.time()) + 3600
+
+    def repo(self, owner, name):
+        match = re.fullmatch(r'owner(\d+)', owner)
+        if match is None or int(match.group(1)) >= self.repos or name != f'repo{match.group(1)}':
+            return None
+        i = int(match.group(1))
+        rnd = random.Random(self.seed * 1000003 + i)
+        return {'id': i + 1, 'name': name, 'full_name': f'{owner}/{name}',
+                'owner': {'id': i + 1, 'login': owner, 'type': 'User'},
+                'html_url': f'https://github.com/{owner}/{name}',
+                'description': f'A {rnd.choice(LANGUAGES)} library for {rnd.choice(TOPICS)}',
+                'created_at': '2020-01-01T00:00:00Z', 'updated_at': '2024-01-01T00:00:00Z',
+                'pushed_at': '2024-01-01T00:00:00Z', 'clone_url': f'https://github.com/{owner}/{name}.git',
+                'size': rnd.randint(10, 100000), 'stargazers_count': int(100000 * rnd.random() ** 4),
+                'watchers_count': rnd.randint(0, 1000), 'language': rnd.choice(LANGUAGES),
+                'has_issues': True, 'has_projects': True, 'has_downloads': True, 'has_wiki': True,
+                'has_pages': False, 'has_discussions': False, 'forks_count': rnd.randint(0, 5000),
+                'archived': False, 'disabled': False, 'open_issues_count': rnd.randint(0, 500),
+                'license': {'key': 'mit'}, 'allow_forking': True, 'is_template': False,
+                'topics': rnd.sample(['python', 'ml', 'web', 'cli', 'database', 'api'], 2),
+                'visibility': 'public', 'forks': 0, 'open_issues': 0, 'watchers': 0, 'default_branch': 'main'}
+
+
+class _GithubHandler(_Handler):
+    def do_GET(self):
+        fake = self.server.fake
+        count = fake.count_request()
+        time.sleep(fake.latency)
+        parts = self.path.strip('/').split('/')
+        if parts[0] == 'gharchive' and fake.archive is not None:
+            with open(fake.archive, 'rb') as f:
+                return self.send_body(200, f.read(), 'application/gzip')
+        headers = {}
+        body = None
+        if parts[0] == 'repos' and len(parts) >= 3:
+            headers = {'X-RateLimit-Limit': str(fake.rate_limit),
+                       'X-RateLimit-Remaining': str(max(fake.rate_limit - count, 0)),
+                       'X-RateLimit-Reset': str(fake.reset_at)}
+            repo = fake.repo(parts[1], parts[2])
+            if repo is not None and len(parts) == 3:
+                body = json.dumps(repo)
+            elif repo is not None and parts[3:] == ['languages']:
+                body = json.dumps({repo['language']: 1000, 'Shell': 10})
+            elif repo is not None and parts[3:] == ['contributors']:
+                body = json.dumps([{'login': f'user{i}'} for i in range(repo['id'] % 20 + 1)])
+        elif len(parts) == 4 and parts[3] == 'README.md':
+            repo = fake.repo(parts[0], parts[1])
+            if repo is not None:
+                body = README.format(name=repo['name'], language=repo['language'],
+                                     topic=repo['description'].split(' for ')[-1])
+        if body is None:
+            return self.send_body(404, '{"message": "Not Found"}', headers=headers)
+        headers['ETag'] = '"' + hashlib.sha1(body.encode('utf-8')).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == headers['ETag']:
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_body(200, body, headers=headers)
+
+
+class FakeOpenai(_Server):
+    """
+    Answers chat completions with `SEARCH_SQL` for sql prompts and `EXPLANATION` otherwise, and embeds texts
+    (or token lists) into deterministic random unit vectors. `latency` is added to every request,
+    `token_latency` per streamed chunk.
+    """
+
+    def __init__(self, latency=0.0, token_latency=0.0, dimensions=1536):
+        super().__init__(_OpenaiHandler)
+        self.latency = latency
+        self.token_latency = token_latency
+        self.dimensions = dimensions
+
+    def embedding(self, value):
+        rnd = random.Random(hashlib.sha1(json.dumps(value).encode('utf-8')).digest())
+        vector = [rnd.gauss(0, 1) for _ in range(self.dimensions)]
+        norm = sum(x * x for x in vector) ** 0.5
+        return [x / norm for x in vector]
+
+
+class _OpenaiHandler(_Handler):
+    def do_POST(self):
+        fake = self.server.fake
+        fake.count_request()
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        time.sleep(fake.latency)
+        path = self.path.split('?')[0]
+        if path.endswith('/embeddings'):
+            inputs = request['input'] if isinstance(request['input'], list) else [request['input']]
+            data = [{'object': 'embedding', 'index': i, 'embedding': fake.embedding(value)}
+                    for i, value in enumerate(inputs)]
+            return self.send_body(200, json.dumps({'object': 'list', 'data': data, 'model': 'text-embedding-ada-002',
+                                                   'usage': {'prompt_tokens': 0, 'total_tokens': 0}}))
+        if path.endswith('/chat/completions'):
+            prompt = request['messages'][-1]['content']
+            content = SEARCH_SQL if 'Postgresql tables schemas' in prompt else EXPLANATION
+            if request.get('stream'):
+                return self._stream(content)
+            return self.send_body(200, json.dumps({
+                'id': str(uuid.uuid4()), 'object': 'chat.completion', 'created': int(time.time()),
+                'model': request.get('model', 'gpt'),
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': content}}],
+                'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4,
+                          'total_tokens': (len(prompt) + len(content)) // 4}}))
+        self.send_body(404, '{"error": {"message": "Not Found"}}')
+
+    def _stream(self, content):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for word in re.findall(r'\S+\s*', content):
+            chunk = {'id': 'chunk', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': 'gpt',
+                     'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}]}
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(self.server.fake.token_latency)
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.close_connection = True
+
+
+class Postgres:
+    """
+    A scratch database, dropped on exit. Uses the server given by BENCH_PG_HOST/PORT/USER/PASSWORD when set,
+    otherwise starts a pgvector/pgvector container (needs docker). `env` holds the webapp DB_* settings.
+    """
+
+    IMAGE = 'pgvector/pgvector:pg16'
+
+    def __init__(self, name='githubmeta_bench'):
+        self.name = name
+        self.container = None
+        self.host = os.environ.get('BENCH_PG_HOST')
+        self.port = int(os.environ.get('BENCH_PG_PORT', '5432'))
+        self.user = os.environ.get('BENCH_PG_USER', 'postgres')
+        self.password = os.environ.get('BENCH_PG_PASSWORD', 'postgres')
+
+    def __enter__(self):
+        if self.host is None:
+            self._start_container()
+        self._admin(f'DROP DATABASE IF EXISTS {self.name};', f'CREATE DATABASE {self.name};')
+        self.env = {'DB_HOST': self.host, 'DB_PORT': str(self.port), 'DB_USER': self.user,
+                    'DB_PASSWORD': self.password, 'DB_NAME': self.name, 'DB_SSLMODE': 'disable'}
+        return self
+
+    def __exit__(self, *exc):
+        if self.container is not None:
+            subprocess.run(['docker', 'rm', '-f', self.container], capture_output=True)
+            return
+        self._admin(f'DROP DATABASE IF EXISTS {self.name} WITH (FORCE);')
+
+    def _admin(self, *statements):
+        import psycopg2
+        conn = psycopg2.connect(host=self.host, port=self.port, user=self.user, password=self.password,
+                                dbname='postgres')
+        conn.autocommit = True
+        try:
+            for statement in statements:
+                conn.cursor().execute(statement)
+        finally:
+            conn.close()
+
+    def _start_container(self):
+        if shutil.which('docker') is None:
+            raise RuntimeError('Set BENCH_PG_HOST to a Postgres server with pgvector, or install docker')
+        self.container = subprocess.run(
+            ['docker', 'run', '-d', '--rm', '-p', '127.0.0.1::5432', '-e', f'POSTGRES_PASSWORD={self.password}',
+             self.IMAGE], check=True, capture_output=True, text=True).stdout.strip()
+        port = subprocess.run(['docker', 'port', self.container, '5432/tcp'], check=True, capture_output=True,
+                              text=True).stdout.split(':')[-1]
+        self.host, self.port = '127.0.0.1', int(port)
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                self._admin('SELECT 1;')
+                return
+            except Exception:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
@@ -1,36 +1,104 @@
+import gzip
+import heapq
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from operator import itemgetter
+
 import requests
-import tempfile
-import gzip
+
+ARCHIVE_URL = os.environ.get("ARCHIVE_URL", "https://data.gharchive.org/{year}-{month:02d}-{day:02d}-{hour}.json.gz")
 
 
-def download_file(url, filename):
-    with requests.get(url, stream=True) as r:
+def stream_archive_lines(url):
+    """Yield the raw (bytes) event lines of a GH Archive file, decompressed straight from the HTTP response."""
+    with requests.get(url, stream=True, timeout=60) as r:
         r.raise_for_status()
-        with open(filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+        with gzip.GzipFile(fileobj=r.raw) as f:
+            yield from f
+
+
+def count_repo_events(lines):
+    """
+    Count closed pull requests and stars per public repo in GH Archive event lines.
+    Lines are checked for the event type text before being decoded, so most events are never json parsed.
+    """
+    repos = {}
+    for line in lines:
+        if b'"WatchEvent"' not in line and (b'"PullRequestEvent"' not in line or b'"closed"' not in line):
+            continue
+        data = json.loads(line)
+        if data['public'] and ((data['type'] == "PullRequestEvent" and data['payload']['action'] == 'closed')
+                               or (data['type'] == 'WatchEvent')):
+            repo = data['repo']['name']
+            repos[repo] = repos.get(repo, 0) + 1
+    return repos
+
+
+def top_repos(repos, n=2000):
+    """The names of the `n` repos with the highest counts, in descending order."""
+    return [k for k, v in heapq.nlargest(n, repos.items(), key=itemgetter(1))]
+
+
+def retrieve_repo_counts(year, month, day, hour):
+    url = ARCHIVE_URL.format(year=year, month=month, day=day, hour=hour)
+    print(f"Streaming {url}...")
+    return count_repo_events(stream_archive_lines(url))
 
 
 def retrieve_repos(year, month, day, hour):
     """
     Retrieve repos active last week.
     """
-    repos = {}
-    url = f"https://data.gharchive.org/{year}-{month:02d}-{day:02d}-{hour}.json.gz"
-    filename = os.path.join(tempfile.gettempdir(), os.path.basename(url))
-    print(f"Downloading {url}...")
-    download_file(url, filename)
-    with gzip.open(filename, 'rt') as f:
-        for line in f:
-            data = json.loads(line)
-            if data['public'] and ((data['type'] == "PullRequestEvent" and data['payload']['action'] == 'closed')
-                                   or (data['type'] == 'WatchEvent')):
-                repo = data['repo']['name']
-                if repo not in repos:
-                    repos[repo] = 0
-                repos[repo] += 1
-    os.remove(filename)
-    repos = [k for k, v in sorted(repos.items(), key=lambda item: -item[1])]
-    return repos[:2000]  # Only first 2000 repos
+    return top_repos(retrieve_repo_counts(year, month, day, hour))  # Only first 2000 repos
+
+
+def hour_key(hour):
+    return hour.strftime('%Y-%m-%dT%H')
+
+
+def load_checkpoint(path):
+    """
+    {'done': keys of the hours already loaded, 'start': key of the first hour the timer loads}, None when there is
+    no checkpoint yet.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        checkpoint = json.load(f)
+    return {'done': set(checkpoint['done']), 'start': checkpoint.get('start')}
+
+
+def save_checkpoint(path, done, start=None, keep=24 * 30):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'done': sorted(done)[-keep:], 'start': start}, f)
+    os.replace(tmp, path)
+
+
+def retrieve_hours(hours, workers):
+    """
+    Count the repo events of each hour's archive, one archive per worker process.
+    Returns {hour: counts} for the hours that succeeded, failed hours are left out to be retried.
+    """
+    res = {}
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {pool.submit(retrieve_repo_counts, h.year, h.month, h.day, h.hour): h for h in hours}
+        for future in as_completed(futures):
+            hour = futures[future]
+            try:
+                res[hour] = future.result()
+            except Exception as ex:
+                print(f"Failed to retrieve repos of {hour_key(hour)}, error: {ex}")
+    return res
+
+
+def merge_counts(hour_counts, now, half_life_hours=24):
+    """Trending score of each repo: the sum of its hourly counts, halving the weight every `half_life_hours`."""
+    scores = {}
+    for hour, counts in hour_counts.items():
+        weight = 0.5 ** (max((now - hour).total_seconds(), 0) / 3600 / half_life_hours)
+        for repo, count in counts.items():
+            scores[repo] = scores.get(repo, 0) + count * weight
+    return scores
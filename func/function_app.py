@@ -1,20 +1,107 @@
 import azure.functions as func
 import datetime
+import json
 import logging
+import os
+import tempfile
+import time
 import requests
 import func_utils
 
 app = func.FunctionApp()
 
+LOAD_REPOS_URL = os.environ.get("LOAD_REPOS_URL", "https://githubmeta.azurewebsites.net/api/load_repos")
+# The hours already loaded. The default is under $HOME, the storage share the function app keeps across restarts
+# and instances, the temp dir is only used where HOME isn't set. Point it to any persistent path.
+CHECKPOINT_PATH = os.environ.get("CHECKPOINT_PATH",
+                                 os.path.join(os.environ.get("HOME", tempfile.gettempdir()), "data", "githubmeta",
+                                              "load_repos_checkpoint.json"))
+# Hours looked back at by the timer to catch up on missed runs.
+BACKFILL_HOURS = int(os.environ.get("BACKFILL_HOURS", "24"))
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", "4"))
+DELIVERY_CHUNK_SIZE = int(os.environ.get("DELIVERY_CHUNK_SIZE", "500"))
+# Seconds a run may spend loading hours, below the functionTimeout of host.json (5 minutes).
+LOAD_BUDGET = float(os.environ.get("LOAD_BUDGET", "240"))
+
+
+def latest_hour():
+    """The latest hour whose archive is surely published."""
+    return (datetime.datetime.now() - datetime.timedelta(hours=2)).replace(minute=0, second=0, microsecond=0)
+
+
+def load_hours(hours, watermark=False, budget=LOAD_BUDGET):
+    """
+    Load the trending repos of the hours not in the checkpoint yet, and with `watermark` only the hours from the
+    checkpoint start hour on. Archives are processed in parallel, a group of `BACKFILL_WORKERS` hours at a time,
+    and each group is posted and checkpointed before the next one so a timeout doesn't lose the hours already done.
+    No group is started when the slowest one so far wouldn't end within `budget` seconds.
+    Returns the keys of the hours loaded and of the hours still to load.
+    """
+    start_time = time.monotonic()
+    slowest = 0.0
+    loaded = []
+    checkpoint = func_utils.load_checkpoint(CHECKPOINT_PATH)
+    if checkpoint is None:
+        # First run, start from the latest hour, older hours can be loaded with the backfill route.
+        checkpoint = {'done': set(), 'start': func_utils.hour_key(max(hours))}
+        func_utils.save_checkpoint(CHECKPOINT_PATH, checkpoint['done'], checkpoint['start'])
+    done, start = checkpoint['done'], checkpoint['start']
+    todo = [h for h in hours if func_utils.hour_key(h) not in done
+            and not (watermark and start is not None and func_utils.hour_key(h) < start)]
+    logging.info(f'{len(todo)} hours to load: {[func_utils.hour_key(h) for h in todo]}')
+    for i in range(0, len(todo), BACKFILL_WORKERS):
+        if time.monotonic() - start_time + slowest > budget:
+            logging.info(f'Out of time, {len(todo) - i} hours left')
+            break
+        group_start = time.monotonic()
+        group = todo[i:i + BACKFILL_WORKERS]
+        counts = func_utils.retrieve_hours(group, BACKFILL_WORKERS)
+        if counts:
+            scores = func_utils.merge_counts(counts, latest_hour())
+            if post_repos(func_utils.top_repos(scores), scores):
+                done.update(func_utils.hour_key(h) for h in counts)
+                func_utils.save_checkpoint(CHECKPOINT_PATH, done, start)
+                loaded.extend(func_utils.hour_key(h) for h in counts)
+        slowest = max(slowest, time.monotonic() - group_start)
+    return sorted(loaded), sorted(func_utils.hour_key(h) for h in todo if func_utils.hour_key(h) not in done)
+
+
+def post_repos(repos, scores):
+    """
+    Send the repos to the webapp ingest queue in chunks of `DELIVERY_CHUNK_SIZE`, with their trending scores as
+    priorities. Returns whether all of them were queued, stops at the first chunk the webapp rejects.
+    """
+    headers = {"contentType": "application/json"}
+    for i in range(0, len(repos), DELIVERY_CHUNK_SIZE):
+        chunk = repos[i:i + DELIVERY_CHUNK_SIZE]
+        payload = {"items": chunk, "priorities": [round(scores[repo], 3) for repo in chunk]}
+        response = requests.post(LOAD_REPOS_URL, headers=headers, json=payload)
+        logging.info(f'{response.status_code} {response.text}')
+        if not response.ok:
+            return False
+    return True
+
 
 @app.timer_trigger(schedule="0 0 * * * *", arg_name="myTimer", run_on_startup=False, use_monitor=False)
 def LoadRepos(myTimer: func.TimerRequest) -> None:
     if myTimer.past_due:
         logging.info('The timer is past due!')
-    date = datetime.datetime.now() - datetime.timedelta(hours=2)
-    repos = func_utils.retrieve_repos(date.year, date.month, date.day, date.hour)
-    headers = {"contentType": "application/json"}
-    payload = {"items": repos}
-    response = requests.post("https://githubmeta.azurewebsites.net/api/load_repos", headers=headers, json=payload)
-    logging.info(response.status_code)
-    logging.info('Python timer trigger function executed.')
\ No newline at end of file
+    latest = latest_hour()
+    load_hours([latest - datetime.timedelta(hours=i) for i in range(BACKFILL_HOURS)], watermark=True)
+    logging.info('Python timer trigger function executed.')
+
+
+@app.route(route="backfill", auth_level=func.AuthLevel.FUNCTION)
+def Backfill(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Load the hours missing from the checkpoint among the last `hours` hours (a week by default), as many as fit in
+    `LOAD_BUDGET`. Returns the hours loaded and the ones remaining, call again until none remain.
+    """
+    try:
+        hours = int(req.params.get('hours', 24 * 7))
+    except ValueError:
+        return func.HttpResponse("hours must be an integer", status_code=400)
+    latest = latest_hour()
+    loaded, remaining = load_hours([latest - datetime.timedelta(hours=i) for i in range(hours)])
+    return func.HttpResponse(json.dumps({'loaded': loaded, 'remaining': remaining}),
+                             mimetype='application/json')
@@ -1,16 +1,54 @@
 import json
-import time
-import traceback
-from concurrent.futures import ThreadPoolExecutor
-from flask import Flask, send_from_directory, request, Response, jsonify
+import threading
+from flask import Flask, send_from_directory, request, Response, jsonify, stream_with_context
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+import ingest
+import metrics
 import utils
+from config import Configuration
+from search import answer
 
 app = Flask(__name__, static_folder='frontend/build')
 limiter = Limiter(app=app, key_func=get_remote_address, default_limits=["400 per day", "100 per hour"])
-executor = ThreadPoolExecutor(1)
-utils.init_db()
+# Limit to 10 searches per hour, shared by the plain and the streaming search routes.
+search_limit = limiter.shared_limit("10/hour", scope="search")
+started = threading.Event()
+_start_lock = threading.Lock()
+
+
+def startup():
+    """
+    Start the ingest workers and the load of the in process readme vectors, once per process at the first request
+    rather than at import, so workers start without touching the database. With `MigrateOnStartup` the schema is
+    migrated first in a background thread, the ingest workers start once it is done.
+    """
+    with _start_lock:
+        if started.is_set():
+            return
+        if Configuration.MigrateOnStartup:
+            threading.Thread(target=_migrate_then_start_ingest, name='migrate', daemon=True).start()
+        else:
+            ingest.queue.start()
+        utils.get_readme_vectors()
+        started.set()
+
+
+def _migrate_then_start_ingest():
+    try:
+        utils.init_db()
+    except Exception as e:
+        print(f"Migration failed: {e}")
+        raise
+    ingest.queue.start()
+
+
+@app.before_request
+def ensure_started():
+    # A metrics scrape only reads, it doesn't start the workers of an idle process.
+    if not started.is_set() and request.endpoint != 'prometheus_metrics':
+        startup()
+
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -22,58 +60,96 @@ def serve(path):
 
 
 @app.route('/api/search')
-@limiter.limit("10/hour")  # Limit to 10 requests per hour for this route
+@search_limit
 def search():
     question = request.args.get('question', '')  # Get search query parameter
-    print(f'Question received: {question}')
-    description = f"Failed to answer question \"{question}\""
-    try:
-        sql = utils.question2sql(utils.load_tables_schema(), question)
-        db_res = None
-        if not (sql is None or sql.isspace()):
-            db_res = utils.execute(sql)
+    for event, data in answer(question):
+        if event == 'done':
+            return data
 
-        if db_res is None:
-            return f"Failed to answer question \"{question}\""
 
-        description = utils.describe(question, db_res)
-        print(f'Answer:\n{description}')
-        utils.save_question(question, description)
-    except Exception as ex:
-        print(traceback.format_exc())
-        print(f"Failed to answer question \"{question}\", exception: {ex}")
-        utils.save_question(question, f'Failed due to {ex}')
+@app.route('/api/search/stream')
+@search_limit
+def search_stream():
+    """Server-sent events version of /api/search, the description is streamed as it is generated."""
+    question = request.args.get('question', '')  # Get search query parameter
+
+    def events():
+        for event, data in answer(question, stream_description=True):
+            yield f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
 
-    return description
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/api/load_repos', methods=['POST'])
-@limiter.limit("10/hour")
+@limiter.limit("120/hour")
 def load_repos():
-    repo_list = request.get_json()['items']  # Get search query parameter
+    body = request.get_json()
+    repo_list = body['items']  # Repo full names
+    priorities = body.get('priorities')  # Optional, higher priorities are loaded first
+    if priorities is not None and len(priorities) != len(repo_list):
+        return jsonify({'error': 'priorities must have one value per item'}), 400
+
+    res = ingest.queue.put(repo_list, priorities)
+    if res['rejected']:
+        # The queue is full, the rejected repos should be sent again later.
+        return jsonify(res), 503, {'Retry-After': str(Configuration.IngestRetryAfter)}
+    return jsonify(res), 200
 
-    def load_repos():
-        for repo in repo_list:
-            try:
-                utils.load_repo(repo)
-                time.sleep(1)
-            except Exception as ex:
-                print(traceback.format_exc())
-                print(f"Failed to load repo {repo}, error: {ex}")
-        print("Finished loading repos.")
 
-    executor.submit(load_repos)
-    return Response(), 200
+@app.route('/api/load_repos/status')
+def load_repos_status():
+    return jsonify(ingest.queue.status())
 
 
 @app.route('/api/summarize')
-@limiter.limit("10/hour")  # Limit to 10 requests per hour for this route
+@limiter.limit(Configuration.SummarizeRateLimit,
+               deduct_when=lambda response: response.status_code != 304)
 def summarize():
     repo = request.args.get('repo', '')  # Get search query parameter
-    print(f"summarizing {repo}")
-    res = utils.summarize_repo(repo)
-    print(res)
-    return json.dumps(res)
+    summary, etag = utils.get_summaries([repo])[repo]
+    response = Response(summary, mimetype='application/json')
+    # Summaries only change when the repo is loaded again, browsers can reuse them and revalidate.
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = Configuration.SummaryMaxAge
+    return response.make_conditional(request)
+
+
+@app.route('/api/summarize/batch', methods=['POST'])
+@limiter.limit(Configuration.SummarizeRateLimit)
+def summarize_batch():
+    """Summaries of up to `SummarizeBatchSize` repos by full name, for pages listing many repos."""
+    repo_list = request.get_json()['items']  # Repo full names
+    if len(repo_list) > Configuration.SummarizeBatchSize:
+        return jsonify({'error': f'At most {Configuration.SummarizeBatchSize} repos per request'}), 400
+    summaries = utils.get_summaries(repo_list)
+    # The summaries are already serialized, splice them instead of parsing them again.
+    body = '{' + ','.join(f'{json.dumps(name)}:{summary}' for name, (summary, _) in summaries.items()) + '}'
+    return Response(body, mimetype='application/json')
+
+
+@app.route('/api/db_stats')
+def db_stats():
+    return jsonify(utils.get_pool().stats())
+
+
+@app.route('/metrics')
+@limiter.exempt
+def prometheus_metrics():
+    """Stage latencies, token counts and a sample of the pools and caches, in the Prometheus text format."""
+    gauges = {f'githubmeta_db_pool_{k}': v for k, v in utils.get_pool().stats().items()}
+    gauges.update({f'githubmeta_embedding_{k}': v for k, v in utils.embedder.stats.items()})
+    for name, lru in [('answer', utils.answer_cache), ('summary', utils.summary_cache), ('http', utils.http_cache)]:
+        gauges[f'githubmeta_{name}_cache_hits'] = lru.hits
+        gauges[f'githubmeta_{name}_cache_misses'] = lru.misses
+    gauges['githubmeta_github_rate_limit_remaining'] = utils.github_rate_limiter.remaining
+    gauges['githubmeta_github_rate_limit_wait_seconds'] = utils.github_rate_limiter.waited_seconds
+    readme_vectors = utils.loaded_readme_vectors()
+    if readme_vectors is not None:
+        gauges['githubmeta_readme_vectors_chunks'] = len(readme_vectors)
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
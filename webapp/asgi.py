@@ -0,0 +1,57 @@
+"""
+Async serving mode: `uvicorn asgi:application`.
+
+/api/search and /api/search/stream are served by an async Quart app, so a request waiting on the model or the
+database doesn't hold a thread and an instance can serve many slow searches at once. The other routes are
+passed to the Flask app.
+"""
+import json
+from datetime import timedelta
+
+from asgiref.wsgi import WsgiToAsgi
+from quart import Quart, Response, request
+from quart_rate_limiter import RateLimiter, rate_limit
+
+import utils
+from app import app as flask_app, started, startup
+from search import aanswer
+
+search_app = Quart(__name__)
+RateLimiter(search_app)
+wsgi_app = WsgiToAsgi(flask_app)
+
+SEARCH_PATHS = {'/api/search', '/api/search/stream'}
+
+
+@search_app.before_request
+async def ensure_started():
+    if not started.is_set():
+        await utils.run_blocking(startup)
+
+
+# Both paths share one endpoint so that they share the 10 searches per hour limit.
+@search_app.route('/api/search')
+@search_app.route('/api/search/stream')
+@rate_limit(10, timedelta(hours=1))
+async def search():
+    question = request.args.get('question', '')  # Get search query parameter
+    if request.path == '/api/search':
+        async for event, data in aanswer(question):
+            if event == 'done':
+                return data
+
+    async def events():
+        async for event, data in aanswer(question, stream_description=True):
+            yield f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.timeout = None  # The description can take longer than the default response timeout
+    return response
+
+
+async def application(scope, receive, send):
+    if scope['type'] != 'http' or scope['path'] in SEARCH_PATHS:
+        await search_app(scope, receive, send)
+    else:
+        await wsgi_app(scope, receive, send)
@@ -0,0 +1,135 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class LRUCache:
+    """A thread safe LRU cache, entries optionally expire `ttl` seconds after they are set."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (self._ttl is not None and time.monotonic() - item[1] > self._ttl):
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskResponseCache:
+    """
+    Stores HTTP response bodies on disk with their `ETag`/`Last-Modified` validators, so they can be
+    revalidated with conditional requests and served locally on `304 Not Modified`.
+    At the first write and then every `prune_every` writes, a background thread removes the entries unused for
+    `max_age` seconds, then the least recently used ones until the folder is under `max_bytes`, and the temporary
+    files left by crashed writers.
+    """
+
+    # Temporary files older than this were left by a crashed writer.
+    STALE_TMP_SECONDS = 3600
+
+    def __init__(self, folder, max_bytes=None, max_age=None, prune_every=200):
+        self._folder = folder
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._prune_every = prune_every
+        self._writes = 0
+        self._prune_lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, url):
+        return os.path.join(self._folder, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url):
+        try:
+            with open(self._path(url), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        try:
+            os.utime(self._path(url))  # The modification time is the last use, for pruning
+        except OSError:
+            pass
+        return entry
+
+    def set(self, url, etag, last_modified, body):
+        path = self._path(url)
+        # Workers of several processes share the folder, thread idents are only unique within one.
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'url': url, 'etag': etag, 'last_modified': last_modified, 'body': body}, f)
+        os.replace(tmp, path)
+        self._writes += 1
+        if self._writes % self._prune_every == 1 or self._prune_every == 1:
+            threading.Thread(target=self.prune, name='http-cache-prune', daemon=True).start()
+
+    def prune(self):
+        """Remove the entries over the age and size limits, skipped while another thread is pruning."""
+        if (self._max_bytes is None and self._max_age is None) or not self._prune_lock.acquire(blocking=False):
+            return
+        try:
+            entries = []
+            now = time.time()
+            for entry in os.scandir(self._folder):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith('.tmp'):
+                    if now - stat.st_mtime > self.STALE_TMP_SECONDS:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, path in entries:
+                expired = self._max_age is not None and now - mtime > self._max_age
+                if not expired and (self._max_bytes is None or total <= self._max_bytes):
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+        finally:
+            self._prune_lock.release()
@@ -0,0 +1,114 @@
+import functools
+import re
+
+import tiktoken
+
+_COMMENT = re.compile(r'<!--.*?-->', re.S)
+_LINKED_IMAGE = re.compile(r'\[!\[[^\]]*\]\([^)]*\)\]\([^)]*\)')
+_IMAGE = re.compile(r'!\[[^\]]*\]\([^)]*\)')
+_LINK = re.compile(r'\[([^\]]*)\]\([^)]*\)')
+_REFERENCE = re.compile(r'^\s*\[[^\]]+\]:\s*\S+.*$', re.M)
+_HTML_TAG = re.compile(r'</?[a-zA-Z][^>]*>')
+_HEADING = re.compile(r'^\s{0,3}(#{1,6})\s+(.*?)\s*#*\s*$')
+_FENCE = re.compile(r'^\s*(```|~~~)')
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def clean_markdown(text):
+    """
+    Drop the parts of a readme that carry no meaning for search: comments, badges, images, html, link urls.
+    Fenced code is kept as is, `#include <vector>` isn't html.
+    """
+    parts, block, in_code = [], [], False
+    for line in text.splitlines(keepends=True):
+        if _FENCE.match(line):
+            if in_code:
+                block.append(line)
+                parts.append(''.join(block))
+                block = []
+            else:
+                parts.append(_clean_prose(''.join(block)))
+                block = [line]
+            in_code = not in_code
+        else:
+            block.append(line)
+    parts.append(''.join(block) if in_code else _clean_prose(''.join(block)))
+    return ''.join(parts)
+
+
+def _clean_prose(text):
+    text = _COMMENT.sub('', text)
+    text = _LINKED_IMAGE.sub('', text)
+    text = _IMAGE.sub('', text)
+    text = _LINK.sub(r'\1', text)
+    text = _REFERENCE.sub('', text)
+    return _HTML_TAG.sub('', text)
+
+
+def split_sections(text):
+    """Split markdown into (heading, paragraphs) sections, code blocks are kept as one paragraph."""
+    sections = []
+    heading, paragraphs, lines = '', [], []
+    in_code = False
+
+    def end_paragraph():
+        paragraph = ' '.join(' '.join(lines).split())
+        if paragraph:
+            paragraphs.append(paragraph)
+        lines.clear()
+
+    for line in text.splitlines():
+        if _FENCE.match(line):
+            in_code = not in_code
+            if not in_code:
+                end_paragraph()
+            continue
+        match = None if in_code else _HEADING.match(line)
+        if match:
+            end_paragraph()
+            if paragraphs or heading:
+                sections.append((heading, paragraphs))
+            heading, paragraphs = match.group(2), []
+        elif not line.strip() and not in_code:
+            end_paragraph()
+        else:
+            lines.append(line)
+    end_paragraph()
+    if paragraphs or heading:
+        sections.append((heading, paragraphs))
+    return sections
+
+
+def chunk_markdown(text, max_tokens=256, overlap_tokens=32):
+    """
+    Split a markdown document into chunks of at most `max_tokens` tokens, in memory.
+    Chunks don't cross section boundaries and start with their section heading, paragraphs are packed
+    together and only paragraphs longer than a chunk are cut, with `overlap_tokens` tokens of overlap.
+    """
+    encoding = _encoding()
+    chunks = []
+    for heading, paragraphs in split_sections(clean_markdown(text)):
+        prefix = f"{heading}: " if heading else ''
+        budget = max(max_tokens - len(encoding.encode(prefix, disallowed_special=())), overlap_tokens + 1)
+        current, current_tokens = [], 0
+        for paragraph in paragraphs:
+            tokens = len(encoding.encode(paragraph, disallowed_special=()))
+            if current and current_tokens + tokens > budget:
+                chunks.append(prefix + ' '.join(current))
+                current, current_tokens = [], 0
+            if tokens <= budget:
+                current.append(paragraph)
+                current_tokens += tokens
+                continue
+            encoded = encoding.encode(paragraph, disallowed_special=())
+            for start in range(0, len(encoded), budget - overlap_tokens):
+                chunks.append(prefix + encoding.decode(encoded[start:start + budget]))
+                if start + budget >= len(encoded):
+                    break
+        if current:
+            chunks.append(prefix + ' '.join(current))
+    return chunks
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 class Configuration:
@@ -6,6 +7,8 @@ class Configuration:
 
     GithubUsername = os.environ["GITHUB_USERNAME"]
     GithubToken = os.environ["GITHUB_TOKEN"]
+    GithubApiUrl = os.environ.get("GITHUB_API_URL", "https://api.github.com").rstrip('/')
+    GithubRawUrl = os.environ.get("GITHUB_RAW_URL", "https://raw.githubusercontent.com").rstrip('/')
 
     OpenaiApiType = os.environ["OPENAI_API_TYPE"]
     OpenaiApiKey = os.environ["OPENAI_API_KEY"]
@@ -16,3 +19,97 @@ class Configuration:
     DbHost = os.environ["DB_HOST"]
     DbPassword = os.environ["DB_PASSWORD"]
     DbUser = os.environ["DB_USER"]
+    DbPort = int(os.environ.get("DB_PORT", "5432"))
+    DbName = os.environ.get("DB_NAME", "githubmeta")
+    DbSslMode = os.environ.get("DB_SSLMODE", "require")
+
+    DbPoolMinSize = int(os.environ.get("DB_POOL_MIN_SIZE", "1"))
+    DbPoolMaxSize = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+    DbPoolTimeout = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+    DbPoolMaxIdle = float(os.environ.get("DB_POOL_MAX_IDLE", "300"))
+    DbPoolCheckInterval = float(os.environ.get("DB_POOL_CHECK_INTERVAL", "30"))
+
+    SchemaCacheTtl = float(os.environ.get("SCHEMA_CACHE_TTL", "3600"))
+
+    AnswerCacheSize = int(os.environ.get("ANSWER_CACHE_SIZE", "1024"))
+    AnswerCacheTtl = float(os.environ.get("ANSWER_CACHE_TTL", "86400"))
+    AnswerCacheThreshold = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.97"))
+    # How often the time of the last ingest, which invalidates the answers, is read from the database.
+    AnswerIngestCheckInterval = float(os.environ.get("ANSWER_INGEST_CHECK_INTERVAL", "30"))
+    # Request the sql while the question is embedded and looked up in the answer cache (threaded server only, the
+    # async one always does and cancels it on a hit). Faster on a cache miss, wastes the completion on a hit.
+    SearchConcurrentSql = os.environ.get("SEARCH_CONCURRENT_SQL", "true").lower() == "true"
+
+    IoWorkers = int(os.environ.get("IO_WORKERS", "16"))
+
+    GithubRequestsPerSecond = float(os.environ.get("GITHUB_REQUESTS_PER_SECOND", "10"))
+    GithubRequestsBurst = int(os.environ.get("GITHUB_REQUESTS_BURST", "20"))
+    GithubRateLimitReserve = int(os.environ.get("GITHUB_RATE_LIMIT_RESERVE", "100"))
+    IngestFetchWorkers = int(os.environ.get("INGEST_FETCH_WORKERS", "8"))
+    IngestBatchSize = int(os.environ.get("INGEST_BATCH_SIZE", "50"))
+    DbWriteBatchSize = int(os.environ.get("DB_WRITE_BATCH_SIZE", "500"))
+
+    HttpCacheDir = os.environ.get("HTTP_CACHE_DIR", os.path.join(tempfile.gettempdir(), "githubmeta-http-cache"))
+    HttpCacheMaxBytes = int(os.environ.get("HTTP_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))
+    HttpCacheMaxAge = float(os.environ.get("HTTP_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+    HttpPoolSize = int(os.environ.get("HTTP_POOL_SIZE", "16"))
+    HttpTimeout = float(os.environ.get("HTTP_TIMEOUT", "30"))
+    IngestIncremental = os.environ.get("INGEST_INCREMENTAL", "true").lower() == "true"
+
+    HnswM = int(os.environ.get("HNSW_M", "16"))
+    HnswEfConstruction = int(os.environ.get("HNSW_EF_CONSTRUCTION", "64"))
+    HnswEfSearch = int(os.environ.get("HNSW_EF_SEARCH", "200"))
+    MatchReadmeCandidates = int(os.environ.get("MATCH_README_CANDIDATES", "10"))
+    # Index the readme embeddings at half precision (needs pgvector >= 0.7).
+    CompactEmbeddings = os.environ.get("COMPACT_EMBEDDINGS", "false").lower() == "true"
+    # Find the nearest readme chunks in process (vectors.py) instead of with match_readme in the database.
+    ReadmeVectorsInProcess = os.environ.get("README_VECTORS_IN_PROCESS", "false").lower() == "true"
+    ReadmeVectorsDir = os.environ.get("README_VECTORS_DIR",
+                                      os.path.join(tempfile.gettempdir(), "githubmeta-readme-vectors"))
+    ReadmeVectorsRefreshInterval = float(os.environ.get("README_VECTORS_REFRESH_INTERVAL", "60"))
+
+    IngestQueueSize = int(os.environ.get("INGEST_QUEUE_SIZE", "10000"))
+    IngestQueueBatchSize = int(os.environ.get("INGEST_QUEUE_BATCH_SIZE", "200"))
+    IngestRecentTtl = float(os.environ.get("INGEST_RECENT_TTL", "21600"))
+    IngestRetryAfter = int(os.environ.get("INGEST_RETRY_AFTER", "600"))
+    IngestWorkers = int(os.environ.get("INGEST_WORKERS", "2"))
+    IngestMaxAttempts = int(os.environ.get("INGEST_MAX_ATTEMPTS", "5"))
+    IngestRetryBackoff = float(os.environ.get("INGEST_RETRY_BACKOFF", "60"))
+    # Workers refresh the heartbeat of their running jobs, jobs without one for the timeout are requeued.
+    IngestHeartbeatInterval = float(os.environ.get("INGEST_HEARTBEAT_INTERVAL", "30"))
+    IngestHeartbeatTimeout = float(os.environ.get("INGEST_HEARTBEAT_TIMEOUT", "120"))
+    IngestPollInterval = float(os.environ.get("INGEST_POLL_INTERVAL", "10"))
+
+    EmbeddingBatchSize = int(os.environ.get("EMBEDDING_BATCH_SIZE", "1000"))
+    EmbeddingMaxRequestTokens = int(os.environ.get("EMBEDDING_MAX_REQUEST_TOKENS", "100000"))
+    EmbeddingWindow = float(os.environ.get("EMBEDDING_WINDOW", "0.02"))
+    EmbeddingConcurrency = int(os.environ.get("EMBEDDING_CONCURRENCY", "4"))
+    EmbeddingCacheSize = int(os.environ.get("EMBEDDING_CACHE_SIZE", "10000"))
+
+    ReadmeChunkTokens = int(os.environ.get("README_CHUNK_TOKENS", "256"))
+    ReadmeChunkOverlap = int(os.environ.get("README_CHUNK_OVERLAP", "32"))
+
+    SummaryCacheSize = int(os.environ.get("SUMMARY_CACHE_SIZE", "10000"))
+    SummaryCacheTtl = float(os.environ.get("SUMMARY_CACHE_TTL", "600"))
+    SummaryMaxAge = int(os.environ.get("SUMMARY_MAX_AGE", "3600"))
+    SummarizeBatchSize = int(os.environ.get("SUMMARIZE_BATCH_SIZE", "100"))
+    SummarizeRateLimit = os.environ.get("SUMMARIZE_RATE_LIMIT", "600/hour")
+
+    GeneratedSqlTimeout = float(os.environ.get("GENERATED_SQL_TIMEOUT", "15"))
+    GeneratedSqlMaxRows = int(os.environ.get("GENERATED_SQL_MAX_ROWS", "200"))
+    GeneratedSqlMaxBytes = int(os.environ.get("GENERATED_SQL_MAX_BYTES", "100000"))
+    GeneratedSqlMaxCost = float(os.environ.get("GENERATED_SQL_MAX_COST", "10000000"))
+    GeneratedSqlFetchSize = int(os.environ.get("GENERATED_SQL_FETCH_SIZE", "100"))
+
+    DescribePromptTokens = int(os.environ.get("DESCRIBE_PROMPT_TOKENS", "2000"))
+    DescribePromptCellChars = int(os.environ.get("DESCRIBE_PROMPT_CELL_CHARS", "60"))
+    DescribeCellChars = int(os.environ.get("DESCRIBE_CELL_CHARS", "200"))
+    DescribeMaxWords = int(os.environ.get("DESCRIBE_MAX_WORDS", "150"))
+    DescribeMaxTokens = int(os.environ.get("DESCRIBE_MAX_TOKENS", "400"))
+
+    # Print the prompts and model outputs of every request.
+    Debug = os.environ.get("DEBUG", "false").lower() == "true"
+
+    # Migrations run with `python migrations.py` at deploy. When enabled, each process also runs them in the
+    # background at its first request, without holding the requests while indexes are built.
+    MigrateOnStartup = os.environ.get("MIGRATE_ON_STARTUP", "false").lower() == "true"
@@ -0,0 +1,140 @@
+import collections
+import threading
+import time
+
+from psycopg2 import extensions
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out within the pool timeout."""
+
+
+class ConnectionPool:
+    """
+    A bounded, thread safe pool of database connections shared by the whole process.
+
+    Connections are created lazily up to `max_size`, idle connections are health checked before being
+    handed out again and closed when they have been idle longer than `max_idle` seconds (never going
+    below `min_size`). Callers block up to `timeout` seconds waiting for a free connection.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=30.0, max_idle=300.0, check_interval=30.0):
+        self._connect = connect
+        self._min_size = min_size
+        self._max_size = max_size
+        self._timeout = timeout
+        self._max_idle = max_idle
+        self._check_interval = check_interval
+        self._idle = collections.deque()  # (conn, last_used), oldest on the left.
+        self._size = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self._stats = {'checkouts': 0, 'timeouts': 0, 'connections_created': 0, 'connections_closed': 0,
+                       'health_check_failures': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0}
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self._timeout
+        conn = None
+        with self._cond:
+            while True:
+                self._evict_idle()
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self._max_size:
+                    self._size += 1
+                    last_used = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f"No database connection available after {self._timeout}s")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+        try:
+            if conn is not None and not self._healthy(conn, last_used):
+                with self._cond:
+                    self._discard(conn, release_slot=False)
+                    self._stats['health_check_failures'] += 1
+                conn = None
+            if conn is None:
+                conn = self._connect()
+                with self._cond:
+                    self._stats['connections_created'] += 1
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - start
+        with self._cond:
+            self._stats['checkouts'] += 1
+            self._stats['wait_seconds_total'] += waited
+            self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], waited)
+        return conn
+
+    def putconn(self, conn):
+        if not conn.closed and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                conn.close()
+        with self._cond:
+            if conn.closed:
+                self._size -= 1
+                self._stats['connections_closed'] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({'size': self._size,
+                          'idle': len(self._idle),
+                          'in_use': self._size - len(self._idle),
+                          'waiting': self._waiting,
+                          'min_size': self._min_size,
+                          'max_size': self._max_size})
+        return stats
+
+    def _healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self._check_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        while self._idle and self._size > self._min_size and now - self._idle[0][1] > self._max_idle:
+            conn, _ = self._idle.popleft()
+            self._discard(conn)
+
+    def _discard(self, conn, release_slot=True):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._stats['connections_closed'] += 1
+        if release_slot:
+            self._size -= 1
@@ -0,0 +1,115 @@
+import array
+import hashlib
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import tiktoken
+
+import cache
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces the texts embedded by concurrent callers (ingest batches, search questions) into full size
+    embedding requests.
+
+    Texts are collected for `window` seconds, then sent `max_batch` texts or `max_request_tokens` tokens at a
+    time, up to `concurrency` requests in parallel. Texts longer than `max_input_tokens` are truncated.
+    Embeddings are cached by text hash, identical texts (badges, license sections, repeated questions) are
+    embedded once.
+    """
+
+    def __init__(self, embed_fn, max_batch=1000, max_request_tokens=100000, max_input_tokens=8191, window=0.02,
+                 concurrency=4, cache_size=10000):
+        self._embed_fn = embed_fn
+        self._max_batch = max_batch
+        self._max_request_tokens = max_request_tokens
+        self._max_input_tokens = max_input_tokens
+        self._window = window
+        self._cache = cache.LRUCache(maxsize=cache_size)
+        self._pending = []  # (text, key, tokens)
+        self._inflight = {}  # key -> Future
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(concurrency)
+        self._dispatcher = None
+        self._encoding = None  # Loaded on first use, it takes a while
+        self.stats = {'texts': 0, 'cache_hits': 0, 'coalesced': 0, 'requests': 0, 'tokens': 0}
+
+    def embed(self, texts):
+        """The embeddings of the texts, in order. Blocks until they are all computed."""
+        return [future.result() for future in self.submit(texts)]
+
+    def submit(self, texts):
+        """Futures of the embeddings of the texts, in order."""
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+        prepared = []
+        for text in texts:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            if len(tokens) > self._max_input_tokens:
+                tokens = tokens[:self._max_input_tokens]
+                text = self._encoding.decode(tokens)
+            prepared.append((text, hashlib.sha1(text.encode('utf-8')).hexdigest(), len(tokens)))
+
+        futures = []
+        with self._cond:
+            for text, key, count in prepared:
+                self.stats['texts'] += 1
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self.stats['cache_hits'] += 1
+                    future = Future()
+                    future.set_result(cached.tolist())
+                elif key in self._inflight:
+                    self.stats['coalesced'] += 1
+                    future = self._inflight[key]
+                else:
+                    future = Future()
+                    self._inflight[key] = future
+                    self._pending.append((text, key, count))
+                futures.append(future)
+            if self._pending:
+                if self._dispatcher is None:
+                    self._dispatcher = threading.Thread(target=self._dispatch, name='embedding-batcher', daemon=True)
+                    self._dispatcher.start()
+                self._cond.notify()
+        return futures
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            # Give concurrent callers a chance to join the request.
+            time.sleep(self._window)
+            with self._cond:
+                while self._pending:
+                    batch, tokens = [], 0
+                    for text, key, count in self._pending:
+                        if batch and (len(batch) >= self._max_batch or tokens + count > self._max_request_tokens):
+                            break
+                        batch.append((text, key))
+                        tokens += count
+                    del self._pending[:len(batch)]
+                    self.stats['requests'] += 1
+                    self.stats['tokens'] += tokens
+                    self._executor.submit(self._request, batch)
+
+    def _request(self, batch):
+        try:
+            embeddings = list(self._embed_fn([text for text, _ in batch]))
+            if len(embeddings) != len(batch):
+                # The futures of the missing texts would otherwise never resolve.
+                raise ValueError(f"{len(embeddings)} embeddings returned for {len(batch)} texts")
+        except Exception as ex:
+            print(traceback.format_exc())
+            with self._cond:
+                for _, key in batch:
+                    self._inflight.pop(key).set_exception(ex)
+            return
+        with self._cond:
+            for (_, key), embedding in zip(batch, embeddings):
+                self._cache.set(key, array.array('f', embedding))
+                self._inflight.pop(key).set_result(embedding)
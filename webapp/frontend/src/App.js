@@ -3,6 +3,13 @@ import axios from 'axios';
 import Markdown from 'react-markdown';
 import gfm from 'remark-gfm';
 
+function searchError(status) {
+  if (status === undefined || status === 429) {
+    return '_The search failed. Note that you can search at most 10 times per hour, please try again later._';
+  }
+  return `_The search failed (${status}), please try again later._`;
+}
+
 function App() {
   const [inputValue, setInputValue] = useState('');
   const [response, setResponse] = useState('');
@@ -11,10 +18,33 @@ function App() {
     setInputValue("Repositories that " + e.target.value);
   };
 
-  const handleClick = async () => {
-    // Replace with your server URL and endpoint
-    const res = await axios.get(`/api/search?question=${inputValue}`);
-    setResponse(res.data);
+  const handleClick = () => {
+    // Stream the answer so the description shows up while it is being generated.
+    if (!window.EventSource) {
+      axios.get(`/api/search?question=${encodeURIComponent(inputValue)}`)
+        .then(res => setResponse(res.data))
+        .catch(err => setResponse(searchError(err.response && err.response.status)));
+      return;
+    }
+    let description = '';
+    setResponse('_Searching..._');
+    const source = new EventSource(`/api/search/stream?question=${encodeURIComponent(inputValue)}`);
+    source.addEventListener('rows', (e) => {
+      setResponse(`_Found ${JSON.parse(e.data).rows.length} rows, describing..._`);
+    });
+    source.addEventListener('description', (e) => {
+      description += JSON.parse(e.data);
+      setResponse(description);
+    });
+    source.addEventListener('done', (e) => {
+      setResponse(JSON.parse(e.data));
+      source.close();
+    });
+    // EventSource doesn't expose the status, the rate limit (429) is the likely error before any event.
+    source.onerror = () => {
+      source.close();
+      setResponse(description ? `${description}\n\n_The answer was interrupted._` : searchError());
+    };
   };
 
   return (
@@ -0,0 +1,329 @@
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extras import execute_values
+
+import metrics
+import utils
+from config import Configuration
+
+
+class IngestStats:
+    """Counters and per stage timings of one `load_repos` run."""
+
+    def __init__(self, total):
+        self.total = total
+        self.loaded = 0
+        self.failed = 0
+        self.chunks = 0
+        self.skip_reasons = {}
+        self.failures = {}  # requested repo name -> error
+        self.stage_seconds = {'fetch': 0.0, 'chunk': 0.0, 'embed': 0.0, 'db': 0.0}
+        self.started_at = time.monotonic()
+
+    def as_dict(self):
+        elapsed = time.monotonic() - self.started_at
+        skipped = {}
+        for reason in self.skip_reasons.values():
+            skipped[reason] = skipped.get(reason, 0) + 1
+        return {'total': self.total, 'loaded': self.loaded, 'failed': self.failed, 'chunks': self.chunks,
+                'skipped': skipped,
+                'elapsed_seconds': round(elapsed, 3),
+                'repos_per_second': round(self.loaded / elapsed, 3) if elapsed > 0 else None,
+                'stage_seconds': {k: round(v, 3) for k, v in self.stage_seconds.items()},
+                'github_rate_limit_wait_seconds': round(utils.github_rate_limiter.waited_seconds, 3),
+                'github_rate_limit_remaining': utils.github_rate_limiter.remaining,
+                'http_cache_hits': utils.http_cache.hits,
+                'http_cache_misses': utils.http_cache.misses}
+
+
+def load_repos(repo_names, stats=None):
+    """
+    Load the repos into the database. Repos are fetched from GitHub concurrently, then embedded and written
+    in batches of `IngestBatchSize`: one embedding request and one upsert per table for the whole batch.
+    The stored versions of all the repos are read with one query up front so that repos that haven't
+    changed skip the fetch, embedding and upsert work they don't need.
+    """
+    stats = stats or IngestStats(len(repo_names))
+    versions = utils.stored_repo_versions(repo_names)
+
+    def fetch(repo_name):
+        start = time.monotonic()
+        try:
+            repo = utils.fetch_repo(repo_name, versions)
+            if repo is None:
+                stats.failures[repo_name] = "Didn't get repo"
+            else:
+                repo['requested_name'] = repo_name
+            return repo
+        except Exception as ex:
+            print(traceback.format_exc())
+            print(f"Failed to load repo {repo_name}, error: {ex}")
+            stats.failures[repo_name] = str(ex)
+            return None
+        finally:
+            elapsed = time.monotonic() - start
+            stats.stage_seconds['fetch'] += elapsed
+            metrics.stage_seconds.observe(elapsed, pipeline='ingest', stage='fetch')
+
+    batch = []
+    with ThreadPoolExecutor(Configuration.IngestFetchWorkers) as pool:
+        for repo in pool.map(fetch, repo_names):
+            if repo is None:
+                stats.failed += 1
+                continue
+            if repo['skip_reason'] is not None:
+                stats.skip_reasons[repo['full_name']] = repo['skip_reason']
+            if repo['skip_reason'] == 'unchanged':
+                continue
+            batch.append(repo)
+            if len(batch) >= Configuration.IngestBatchSize:
+                _load_batch(batch, stats)
+                batch = []
+    if batch:
+        _load_batch(batch, stats)
+
+    if stats.loaded:
+        utils.invalidate_answers()
+    metrics.ingest_repos.inc(stats.loaded, result='loaded')
+    metrics.ingest_repos.inc(stats.failed, result='failed')
+    metrics.ingest_repos.inc(list(stats.skip_reasons.values()).count('unchanged'), result='unchanged')
+    res = stats.as_dict()
+    print(f"Finished loading repos: {res}")
+    return res
+
+
+def _load_batch(batch, stats):
+    try:
+        _embed_batch(batch, stats)
+        start = time.monotonic()
+        with metrics.timer('ingest', 'db_batch'):
+            utils.load_repos_into_db(batch)
+        stats.stage_seconds['db'] += time.monotonic() - start
+        stats.loaded += len(batch)
+    except Exception as ex:
+        print(traceback.format_exc())
+        print(f"Failed to load batch of {len(batch)} repos, loading them one by one, error: {ex}")
+        for repo in batch:
+            try:
+                if repo['readme_text'] is not None and repo['readme'] is None:
+                    repo['readme'] = list(utils.get_chunked_embeddings(repo, repo['readme_text']))
+                utils.load_repo_into_db(repo)
+                stats.loaded += 1
+            except Exception as ex:
+                print(traceback.format_exc())
+                print(f"Failed to load repo {repo['full_name']}, error: {ex}")
+                stats.failures[repo['requested_name']] = str(ex)
+                stats.failed += 1
+
+
+def _embed_batch(batch, stats):
+    """Embed the readme chunks of all the repos in the batch with a single embedding call."""
+    start = time.monotonic()
+    chunked = []
+    for repo in batch:
+        if repo['readme_text'] is not None:
+            with metrics.timer('ingest', 'chunk'):
+                chunked.append((repo, utils.chunk_readme(repo, repo['readme_text'])))
+    stats.stage_seconds['chunk'] += time.monotonic() - start
+
+    start = time.monotonic()
+    with metrics.timer('ingest', 'embed_batch'):
+        embeddings = utils.embed_texts([text for _, texts in chunked for text in texts])
+    stats.stage_seconds['embed'] += time.monotonic() - start
+
+    offset = 0
+    for repo, texts in chunked:
+        repo['readme'] = list(zip(texts, embeddings[offset:offset + len(texts)]))
+        offset += len(texts)
+        stats.chunks += len(texts)
+
+
+class IngestQueue:
+    """
+    Durable queue of repos to load, kept in the `ingest_jobs` table so pending work survives restarts and is
+    shared by all the instances. `IngestWorkers` threads claim batches highest priority first with
+    `FOR UPDATE SKIP LOCKED`, failed repos are retried with exponential backoff up to `IngestMaxAttempts` times.
+    Claimed jobs carry the id of this process, which refreshes their heartbeat while it is alive: jobs whose
+    heartbeat stopped for `IngestHeartbeatTimeout` seconds are requeued, however long a batch legitimately takes.
+
+    Repos already queued, being loaded, or loaded less than `recent_ttl` seconds ago are not queued again
+    (a duplicate with a higher priority bumps the queued one). Once `maxsize` repos are waiting new ones are
+    rejected so the caller can retry later.
+    """
+
+    def __init__(self, maxsize, recent_ttl, batch_size):
+        self._maxsize = maxsize
+        self._recent_ttl = recent_ttl
+        self._batch_size = batch_size
+        self._workers = []
+        self._cond = threading.Condition()
+        self._current = {}  # worker name -> IngestStats of the batch it is loading
+        self._last_run = None
+        self._id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+    def put(self, repo_names, priorities=None):
+        """Queue the repos, returns the number accepted and duplicated, and the names rejected."""
+        if priorities is None:
+            priorities = [0] * len(repo_names)
+        if len(priorities) != len(repo_names):
+            raise ValueError(f"{len(priorities)} priorities for {len(repo_names)} repos")
+        jobs = {}
+        for name, priority in zip(repo_names, priorities):
+            jobs[name] = max(priority, jobs.get(name, priority))
+        jobs = sorted(jobs.items(), key=lambda item: -item[1])
+
+        conn = utils.get_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT count(*) FROM ingest_jobs WHERE status = 'queued';")
+            room = max(self._maxsize - cursor.fetchone()[0], 0)
+            queued = []
+            if jobs[:room]:
+                queued = execute_values(
+                    cursor,
+                    "INSERT INTO ingest_jobs (repo_name, priority) VALUES %s "
+                    "ON CONFLICT (repo_name) DO UPDATE SET "
+                    "priority = CASE WHEN ingest_jobs.status = 'queued' "
+                    "THEN GREATEST(ingest_jobs.priority, excluded.priority) ELSE excluded.priority END, "
+                    "attempts = CASE WHEN ingest_jobs.status = 'queued' THEN ingest_jobs.attempts ELSE 0 END, "
+                    "next_attempt_at = CASE WHEN ingest_jobs.status = 'queued' "
+                    "THEN ingest_jobs.next_attempt_at ELSE now() END, "
+                    "status = 'queued', enqueued_at = now(), updated_at = now() "
+                    "WHERE (ingest_jobs.status = 'queued' AND excluded.priority > ingest_jobs.priority) "
+                    "OR (ingest_jobs.status IN ('done', 'failed') "
+                    f"AND ingest_jobs.updated_at < now() - make_interval(secs => {float(self._recent_ttl)})) "
+                    "RETURNING repo_name;",
+                    jobs[:room],
+                    fetch=True)
+            conn.commit()
+        finally:
+            utils.close_db(conn)
+        with self._cond:
+            self._cond.notify_all()
+        return {'accepted': len(queued), 'duplicates': len(jobs[:room]) - len(queued),
+                'rejected': [name for name, _ in jobs[room:]]}
+
+    def _take_batch(self):
+        conn = utils.get_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE ingest_jobs SET status = 'running', attempts = attempts + 1, updated_at = now(), "
+                           "worker_id = %s, heartbeat_at = now() "
+                           "WHERE repo_name IN (SELECT repo_name FROM ingest_jobs "
+                           "WHERE status = 'queued' AND next_attempt_at <= now() "
+                           "ORDER BY priority DESC LIMIT %s FOR UPDATE SKIP LOCKED) "
+                           "RETURNING repo_name;",
+                           (self._id, self._batch_size))
+            batch = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            return batch
+        finally:
+            utils.close_db(conn)
+
+    def _finish_batch(self, batch, failures):
+        conn = utils.get_db()
+        try:
+            cursor = conn.cursor()
+            execute_values(cursor,
+                           "UPDATE ingest_jobs SET "
+                           "status = CASE WHEN job.error IS NULL THEN 'done' "
+                           f"WHEN ingest_jobs.attempts >= {int(Configuration.IngestMaxAttempts)} THEN 'failed' "
+                           "ELSE 'queued' END, "
+                           "last_error = job.error, "
+                           f"next_attempt_at = now() + make_interval(secs => {float(Configuration.IngestRetryBackoff)} "
+                           "* power(2, ingest_jobs.attempts - 1)), "
+                           "updated_at = now() "
+                           "FROM (VALUES %s) AS job (repo_name, error, worker_id) "
+                           # Jobs requeued and claimed by another worker meanwhile are left to it.
+                           "WHERE ingest_jobs.repo_name = job.repo_name AND ingest_jobs.status = 'running' "
+                           "AND ingest_jobs.worker_id = job.worker_id;",
+                           [(name, failures.get(name), self._id) for name in batch])
+            conn.commit()
+        finally:
+            utils.close_db(conn)
+
+    def _heartbeat(self):
+        while True:
+            try:
+                conn = utils.get_db()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("UPDATE ingest_jobs SET heartbeat_at = now() "
+                                   "WHERE status = 'running' AND worker_id = %s;", (self._id,))
+                    conn.commit()
+                finally:
+                    utils.close_db(conn)
+            except Exception as ex:
+                print(f"Ingest heartbeat failed, error: {ex}")
+            time.sleep(Configuration.IngestHeartbeatInterval)
+
+    def requeue_stale(self):
+        """Put back jobs left running by a worker that died, e.g. when the instance restarted mid batch."""
+        conn = utils.get_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE ingest_jobs SET status = 'queued', worker_id = NULL, updated_at = now() "
+                           "WHERE status = 'running' "
+                           "AND coalesce(heartbeat_at, updated_at) < now() - make_interval(secs => %s);",
+                           (float(Configuration.IngestHeartbeatTimeout),))
+            if cursor.rowcount:
+                print(f"Requeued {cursor.rowcount} stale ingest jobs")
+            conn.commit()
+        finally:
+            utils.close_db(conn)
+
+    def _run(self):
+        name = threading.current_thread().name
+        while True:
+            try:
+                batch = self._take_batch()
+                if not batch:
+                    self.requeue_stale()
+                    with self._cond:
+                        self._cond.wait(Configuration.IngestPollInterval)
+                    continue
+                stats = IngestStats(len(batch))
+                self._current[name] = stats
+                try:
+                    res = load_repos(batch, stats)
+                except Exception as ex:
+                    print(traceback.format_exc())
+                    print(f"Failed to load batch of {len(batch)} repos, error: {ex}")
+                    stats.failures.update({repo_name: str(ex) for repo_name in batch})
+                    res = stats.as_dict()
+                self._finish_batch(batch, stats.failures)
+                self._current.pop(name, None)
+                self._last_run = res
+            except Exception as ex:
+                print(traceback.format_exc())
+                print(f"Ingest worker {name} failed, error: {ex}")
+                time.sleep(Configuration.IngestPollInterval)
+
+    def start(self):
+        """Resume the jobs interrupted by the last shutdown and start the workers."""
+        if self._workers:
+            return
+        self.requeue_stale()
+        threading.Thread(target=self._heartbeat, name='ingest-heartbeat', daemon=True).start()
+        for i in range(Configuration.IngestWorkers):
+            worker = threading.Thread(target=self._run, name=f'ingest-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def status(self):
+        _, rows = utils.execute("SELECT status, count(*) FROM ingest_jobs GROUP BY status;")
+        res = {status: count for status, count in rows}
+        res.update(max_size=self._maxsize,
+                   workers=len(self._workers),
+                   current_runs=[stats.as_dict() for stats in list(self._current.values())],
+                   last_run=self._last_run)
+        return res
+
+
+queue = IngestQueue(Configuration.IngestQueueSize, Configuration.IngestRecentTtl, Configuration.IngestQueueBatchSize)
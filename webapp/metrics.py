@@ -0,0 +1,104 @@
+import bisect
+import contextlib
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """A thread safe counter per label values, rendered in the Prometheus text format."""
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Histogram:
+    """A thread safe histogram per label values, rendered in the Prometheus text format."""
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [counts per bucket (the last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f'{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}')
+                le = 'le="+Inf"'
+                lines.append(f'{self.name}_bucket{_labels(self.labels, key, le)} {sum(counts)}')
+                lines.append(f'{self.name}_sum{_labels(self.labels, key)} {total}')
+                lines.append(f'{self.name}_count{_labels(self.labels, key)} {sum(counts)}')
+        return lines
+
+
+stage_seconds = Histogram('githubmeta_stage_seconds', 'Duration of the search and ingest stages.',
+                          ['pipeline', 'stage'])
+openai_tokens = Counter('githubmeta_openai_tokens_total', 'Chat completion tokens by call and kind.',
+                        ['call', 'kind'])
+ingest_repos = Counter('githubmeta_ingest_repos_total', 'Repos processed by ingest by result.', ['result'])
+searches = Counter('githubmeta_searches_total', 'Questions answered by result.', ['result'])
+
+REGISTRY = [stage_seconds, openai_tokens, ingest_repos, searches]
+
+
+@contextlib.contextmanager
+def timer(pipeline, stage):
+    """Record the duration of the block in `stage_seconds`, including when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, pipeline=pipeline, stage=stage)
+
+
+def render(gauges=None):
+    """The metrics in the Prometheus text format, followed by the `gauges` {name: value} sampled by the caller."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for name, value in (gauges or {}).items():
+        if value is not None:
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,336 @@
+"""
+Versioned schema migrations, run by `python migrations.py` at deploy (and in the background at the first request
+with MIGRATE_ON_STARTUP).
+
+`MIGRATIONS` are applied once each, in order, and recorded in `schema_version`. `REPEATABLE` objects (functions
+and indexes whose definition depends on settings) are recreated whenever their definition changes, their checksum
+is kept in `schema_objects`. Workers starting together serialize on an advisory lock, and once the schema is current
+`migrate` only reads the two tables.
+"""
+import hashlib
+
+from config import Configuration
+
+# pg_advisory_xact_lock key shared by every instance of the app.
+LOCK_KEY = 5318008
+
+
+def _baseline(cursor):
+    cursor.execute('CREATE EXTENSION IF NOT EXISTS "vector";')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS questions (id SERIAL PRIMARY KEY, text TEXT, result TEXT);''')
+    cursor.execute('''ALTER TABLE questions
+                        ADD COLUMN IF NOT EXISTS sql TEXT,
+                        ADD COLUMN IF NOT EXISTS embedding vector(1536),
+                        ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT now();''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS repos  
+                        (
+                            id INTEGER PRIMARY KEY, 
+                            name TEXT, 
+                            full_name TEXT, 
+                            owner_id INTEGER, 
+                            owner_login TEXT, 
+                            owner_type TEXT, 
+                            html_url TEXT,
+                            description TEXT, 
+                            created_at TEXT, 
+                            updated_at TEXT, 
+                            pushed_at TEXT, 
+                            clone_url TEXT, 
+                            size INTEGER, 
+                            stargazers_count INTEGER, 
+                            watchers_count INTEGER, 
+                            language TEXT, 
+                            has_issues BOOLEAN, 
+                            has_projects BOOLEAN,
+                            has_downloads BOOLEAN, 
+                            has_wiki BOOLEAN, 
+                            has_pages BOOLEAN, 
+                            has_discussions BOOLEAN, 
+                            forks_count INTEGER,
+                            archived BOOLEAN, 
+                            disabled BOOLEAN, 
+                            open_issues_count INTEGER, 
+                            license TEXT, 
+                            allow_forking BOOLEAN, 
+                            is_template BOOLEAN, 
+                            topics TEXT, 
+                            visibility TEXT, 
+                            forks INTEGER, 
+                            open_issues INTEGER, 
+                            watchers INTEGER, 
+                            default_branch TEXT, 
+                            score REAL, 
+                            readme_md5 TEXT, 
+                            extra TEXT
+                        )
+                        ''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS repo_readme_vector  
+                        (
+                            repo_id INTEGER,
+                            chunk_id INTEGER,
+                            text TEXT,
+                            embedding vector(1536)
+                        )
+                        ''')
+    cursor.execute("""DO $$
+                    BEGIN
+                        IF NOT EXISTS (
+                            SELECT 1
+                            FROM   pg_constraint 
+                            WHERE  conname = 'repo_chunk_unique'
+                        )
+                        THEN
+                            ALTER TABLE repo_readme_vector
+                            ADD CONSTRAINT repo_chunk_unique UNIQUE (repo_id, chunk_id);
+                        END IF;
+                    END
+                    $$;
+                    """)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ingest_jobs
+                        (
+                            repo_name TEXT PRIMARY KEY,
+                            priority REAL NOT NULL DEFAULT 0,
+                            status TEXT NOT NULL DEFAULT 'queued',
+                            attempts INTEGER NOT NULL DEFAULT 0,
+                            last_error TEXT,
+                            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                            enqueued_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                        )
+                        ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS ingest_jobs_queued_idx ON ingest_jobs (priority DESC) "
+                   "WHERE status = 'queued';")
+    # Extension summaries materialized at ingest, keyed by lower case full name.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS repo_summaries
+                        (
+                            full_name TEXT PRIMARY KEY,
+                            summary TEXT NOT NULL,
+                            etag TEXT NOT NULL
+                        )
+                        ''')
+    # The approximate nearest neighbour index of the readme chunks is the repeatable `readme_vector_index`.
+
+
+def _search_indexes(cursor):
+    # Word similarity (%>, <%) and LIKE on description and topics, as instructed in the question2sql prompt.
+    cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+    cursor.execute("CREATE INDEX IF NOT EXISTS repos_description_trgm_idx ON repos "
+                   "USING gin (description gin_trgm_ops);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS repos_topics_trgm_idx ON repos USING gin (topics gin_trgm_ops);")
+    # Topics as an array for exact topic matches (topic_list @> ARRAY['x']), and a full text vector.
+    cursor.execute("""ALTER TABLE repos
+                        ADD COLUMN IF NOT EXISTS topic_list TEXT[]
+                            GENERATED ALWAYS AS (string_to_array(topics, ', ')) STORED,
+                        ADD COLUMN IF NOT EXISTS search_vector tsvector
+                            GENERATED ALWAYS AS (to_tsvector('english', coalesce(description, '') || ' ' ||
+                                                                        coalesce(topics, ''))) STORED;""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS repos_topic_list_idx ON repos USING gin (topic_list);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS repos_search_vector_idx ON repos USING gin (search_vector);")
+    # Lookups by name (ingest versions, summaries) and the usual ordering and filter of the generated queries.
+    cursor.execute("CREATE INDEX IF NOT EXISTS repos_full_name_idx ON repos (full_name);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS repos_lower_full_name_idx ON repos (lower(full_name));")
+    cursor.execute("CREATE INDEX IF NOT EXISTS repos_stargazers_count_idx ON repos (stargazers_count DESC);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS repos_language_idx ON repos (language);")
+    cursor.execute("ANALYZE repos;")
+
+
+def _readme_chunks(cursor):
+    # Lets the in-process vector index (vectors.py) find the chunks to reload after another instance ingested.
+    cursor.execute("ALTER TABLE repo_readme_vector ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT now();")
+    cursor.execute("CREATE INDEX IF NOT EXISTS repo_readme_vector_updated_at_idx ON repo_readme_vector (updated_at);")
+    # Stands in for match_readme in the generated queries when the nearest chunks are found in process.
+    cursor.execute("""
+        create or replace function match_readme_chunks (
+          repo_ids int[],
+          chunk_ids int[],
+          similarities float[]
+        )
+        returns table (
+          repo_id int,
+          text text,
+          similarity float
+        )
+        language sql stable
+        as $$
+          select
+            chunks.repo_id,
+            string_agg(repo_readme_vector.text, ' ' order by chunks.chunk_id) AS text,
+            max(chunks.similarity) AS similarity
+          from unnest(repo_ids, chunk_ids, similarities) AS chunks(repo_id, chunk_id, similarity)
+          join repo_readme_vector using (repo_id, chunk_id)
+          group by chunks.repo_id
+          order by max(chunks.similarity) desc;
+        $$;
+        """)
+
+
+def _readme_vector_index():
+    # Approximate nearest neighbour index so match_readme doesn't scan every chunk. Both indexes are dropped first
+    # so that a change of the build parameters rebuilds it.
+    # With CompactEmbeddings the index is built on the half precision cast of the embeddings (pgvector >= 0.7),
+    # half the size of the full precision one, which is kept in the table for re-ranking.
+    options = f"WITH (m = {Configuration.HnswM}, ef_construction = {Configuration.HnswEfConstruction})"
+    drop = ("DROP INDEX IF EXISTS repo_readme_vector_embedding_idx;\n"
+            "DROP INDEX IF EXISTS repo_readme_vector_embedding_half_idx;\n")
+    if Configuration.CompactEmbeddings:
+        return (drop + "CREATE INDEX repo_readme_vector_embedding_half_idx ON repo_readme_vector "
+                f"USING hnsw ((embedding::halfvec(1536)) halfvec_cosine_ops) {options};")
+    return (drop + "CREATE INDEX repo_readme_vector_embedding_idx ON repo_readme_vector "
+            f"USING hnsw (embedding vector_cosine_ops) {options};")
+
+
+def _match_readme():
+    # The index returns the nearest chunks first, they are grouped by repo afterwards.
+    # hnsw.ef_search bounds how many chunks one index scan can return, keep it above the candidate count.
+    # With CompactEmbeddings the candidates come from the half precision index and are re-ranked at full precision.
+    if Configuration.CompactEmbeddings:
+        candidates = f"""(
+              select repo_id, text, embedding
+              from repo_readme_vector
+              order by embedding::halfvec(1536) <=> query_embedding::halfvec(1536)
+              limit match_count * {Configuration.MatchReadmeCandidates}
+            ) AS repo_readme_vector"""
+        limit = ""
+    else:
+        candidates = "repo_readme_vector"
+        limit = f"""
+            order by repo_readme_vector.embedding <=> query_embedding
+            limit match_count * {Configuration.MatchReadmeCandidates}"""
+    return f"""
+        create or replace function match_readme (
+          query_embedding vector(1536),
+          match_threshold float,
+          match_count int
+        )
+        returns table (
+          repo_id int,
+          text text,
+          similarity float
+        )
+        language sql stable
+        set hnsw.ef_search = {Configuration.HnswEfSearch}
+        as $$
+          with nearest_chunks as (
+            select
+              repo_readme_vector.repo_id,
+              repo_readme_vector.text,
+              repo_readme_vector.embedding <=> query_embedding AS distance
+            from {candidates}{limit}
+          )
+          select
+            nearest_chunks.repo_id,
+            string_agg(nearest_chunks.text, ' ') AS text,
+            1 - avg(nearest_chunks.distance) AS similarity
+          from nearest_chunks
+          where nearest_chunks.distance < 1 - match_threshold
+          group by nearest_chunks.repo_id
+          order by avg(nearest_chunks.distance)
+          limit match_count;
+        $$;
+        """
+
+
+def _ingest_state(cursor):
+    # Time of the last ingest write, answers generated before it are not reused by any instance.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ingest_state
+                        (
+                            id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+                            last_loaded_at TIMESTAMPTZ NOT NULL
+                        )
+                        ''')
+
+
+def _question_indexes(cursor):
+    # The semantic answer lookup: nearest reusable question, created after the last ingest.
+    cursor.execute("CREATE INDEX IF NOT EXISTS questions_embedding_idx ON questions "
+                   "USING hnsw (embedding vector_cosine_ops) WHERE sql IS NOT NULL AND embedding IS NOT NULL;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS questions_created_at_idx ON questions (created_at) "
+                   "WHERE sql IS NOT NULL AND embedding IS NOT NULL;")
+
+
+def _ingest_heartbeats(cursor):
+    # The process running a job and when it last showed it was alive, see `IngestQueue.requeue_stale`.
+    cursor.execute("""ALTER TABLE ingest_jobs
+                        ADD COLUMN IF NOT EXISTS worker_id TEXT,
+                        ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMPTZ;""")
+
+
+MIGRATIONS = [
+    (1, 'baseline schema', _baseline),
+    (2, 'trigram, full text and btree indexes on repos', _search_indexes),
+    (3, 'readme chunk update times and match_readme_chunks', _readme_chunks),
+    (4, 'last ingest time', _ingest_state),
+    (5, 'indexes of the semantic answer lookup', _question_indexes),
+    (6, 'ingest job heartbeats', _ingest_heartbeats),
+]
+
+REPEATABLE = [
+    ('readme_vector_index', _readme_vector_index),
+    ('match_readme', _match_readme),
+]
+
+
+def _state(cursor):
+    """The applied schema version and the checksums of the repeatable objects, (0, {}) on a new database."""
+    cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL AND to_regclass('schema_objects') IS NOT NULL;")
+    if not cursor.fetchone()[0]:
+        return 0, {}
+    cursor.execute("SELECT coalesce(max(version), 0) FROM schema_version;")
+    version = cursor.fetchone()[0]
+    cursor.execute("SELECT name, checksum FROM schema_objects;")
+    return version, dict(cursor.fetchall())
+
+
+def _pending(version, checksums):
+    definitions = [(name, definition()) for name, definition in REPEATABLE]
+    return ([m for m in MIGRATIONS if m[0] > version],
+            [(name, sql) for name, sql in definitions if checksums.get(name) != _checksum(sql)])
+
+
+def _checksum(sql):
+    return hashlib.sha1(sql.encode('utf-8')).hexdigest()
+
+
+def migrate(conn):
+    """Apply the pending migrations and repeatable objects in one transaction, returns whether any was."""
+    cursor = conn.cursor()
+    migrations, objects = _pending(*_state(cursor))
+    if not migrations and not objects:
+        conn.rollback()
+        return False
+
+    cursor.execute("SELECT pg_advisory_xact_lock(%s);", (LOCK_KEY,))
+    cursor.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                        (
+                            version INTEGER PRIMARY KEY,
+                            description TEXT,
+                            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                        )
+                        ''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS schema_objects
+                        (
+                            name TEXT PRIMARY KEY,
+                            checksum TEXT NOT NULL,
+                            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                        )
+                        ''')
+    # Another instance may have migrated while this one waited for the lock.
+    migrations, objects = _pending(*_state(cursor))
+    for version, description, apply in migrations:
+        print(f"Applying migration {version}: {description}")
+        apply(cursor)
+        cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s);", (version, description))
+    for name, sql in objects:
+        print(f"Updating {name}")
+        cursor.execute(sql)
+        cursor.execute("INSERT INTO schema_objects (name, checksum) VALUES (%s, %s) "
+                       "ON CONFLICT (name) DO UPDATE SET checksum = excluded.checksum, applied_at = now();",
+                       (name, _checksum(sql)))
+    conn.commit()
+    return True
+
+
+if __name__ == '__main__':
+    import utils
+    utils.init_db()
+    print("Schema is up to date")
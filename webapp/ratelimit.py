@@ -0,0 +1,50 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Client side rate limiter. Tokens refill at `rate` per second up to `capacity` and every request takes one.
+
+    The bucket also follows the `X-RateLimit-Remaining`/`X-RateLimit-Reset` headers of the responses passed to
+    `update`: once fewer than `reserve` requests remain, callers wait until the limit window resets.
+    """
+
+    def __init__(self, rate, capacity, reserve=0):
+        self._rate = rate
+        self._capacity = capacity
+        self._reserve = reserve
+        self._tokens = float(capacity)
+        self._refilled_at = time.monotonic()
+        self._blocked_until = 0.0  # Epoch seconds, as in X-RateLimit-Reset.
+        self._lock = threading.Lock()
+        self.remaining = None
+        self.waited_seconds = 0.0
+
+    def acquire(self):
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._refilled_at) * self._rate)
+                self._refilled_at = now
+                blocked = self._blocked_until - time.time()
+                if blocked <= 0 and self._tokens >= 1:
+                    self._tokens -= 1
+                    self.waited_seconds += now - start
+                    return
+                wait = blocked if blocked > 0 else (1 - self._tokens) / self._rate
+            time.sleep(min(wait, 60))
+
+    def update(self, headers):
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        with self._lock:
+            self.remaining = int(remaining)
+            if self.remaining <= self._reserve:
+                if self._blocked_until < int(reset):
+                    print(f"GitHub rate limit nearly exhausted, {self.remaining} requests left, "
+                          f"waiting until {time.ctime(int(reset))}")
+                self._blocked_until = max(self._blocked_until, int(reset))
@@ -0,0 +1,167 @@
+import asyncio
+import time
+import traceback
+
+import metrics
+import utils
+from config import Configuration
+
+# Keeps the fire-and-forget tasks referenced until they complete.
+_background_tasks = set()
+
+
+def answer(question, stream_description=False):
+    """
+    Answer the question, yielding (event, data) pairs as each stage completes: 'sql', 'rows', then
+    'description' pieces when `stream_description` is set. The last pair is always ('done', description).
+    """
+    start = time.perf_counter()
+    for event, data in _answer(question, stream_description):
+        if event == 'done':
+            metrics.stage_seconds.observe(time.perf_counter() - start, pipeline='search', stage='total')
+        yield event, data
+
+
+def _answer(question, stream_description):
+    print(f'Question received: {question}')
+    description = f"Failed to answer question \"{question}\""
+    try:
+        cached = utils.lookup_answer(question)
+        if cached is None:
+            sql_future = None
+            if Configuration.SearchConcurrentSql:
+                # The sql is requested while the question is embedded and looked up, saving that round trip on
+                # a miss. A running future can't be cancelled: a semantic cache hit still pays for the completion.
+                sql_future = utils.io_executor.submit(utils.question2sql, utils.load_tables_schema(), question)
+            embedding = utils.embed_question(question)
+            cached = utils.lookup_answer(question, embedding)
+        if cached is not None:
+            metrics.searches.inc(result='cached')
+            if Configuration.Debug:
+                print(f'Answer served from cache:\n{cached[1]}')
+            yield 'sql', utils.display_sql(cached[0])
+            yield 'done', cached[1]
+            return
+
+        if sql_future is not None:
+            sql = sql_future.result()
+        else:
+            sql = utils.question2sql(utils.load_tables_schema(), question)
+        yield 'sql', utils.display_sql(sql)
+        db_res = None
+        if not (sql is None or sql.isspace()):
+            db_res = utils.execute_generated(sql, utils.generated_sql_params(embedding, sql))
+
+        if db_res is None:
+            metrics.searches.inc(result='no_result')
+            yield 'done', description
+            return
+        yield 'rows', {'columns': db_res[0], 'rows': db_res[1], 'truncated': db_res[2]}
+
+        if stream_description:
+            pieces = []
+            for piece in utils.describe_stream(question, db_res):
+                pieces.append(piece)
+                yield 'description', piece
+            description = ''.join(pieces)
+        else:
+            description = utils.describe(question, db_res)
+        metrics.searches.inc(result='answered')
+        if Configuration.Debug:
+            print(f'Answer:\n{description}')
+        utils.save_question(question, description, sql, embedding)
+        utils.remember_answer(question, sql, description)
+    except Exception as ex:
+        print(traceback.format_exc())
+        print(f"Failed to answer question \"{question}\", exception: {ex}")
+        metrics.searches.inc(result='failed')
+        utils.save_question(question, f'Failed due to {ex}')
+
+    yield 'done', description
+
+
+def _fire_and_forget(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(_log_failure)
+
+
+def _log_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Background task failed, exception: {task.exception()}")
+
+
+async def aanswer(question, stream_description=False):
+    """
+    Async version of `answer`: the model and database calls are awaited instead of holding a thread, and
+    the question is saved in the background once the answer is sent.
+    """
+    start = time.perf_counter()
+    async for event, data in _aanswer(question, stream_description):
+        if event == 'done':
+            metrics.stage_seconds.observe(time.perf_counter() - start, pipeline='search', stage='total')
+        yield event, data
+
+
+async def _aanswer(question, stream_description):
+    print(f'Question received: {question}')
+    description = f"Failed to answer question \"{question}\""
+    sql_task = None
+    try:
+        cached = await utils.alookup_answer(question)
+        if cached is None:
+            schemas = await utils.run_blocking(utils.load_tables_schema)
+            sql_task = asyncio.ensure_future(utils.aquestion2sql(schemas, question))
+            embedding = await utils.aembed_question(question)
+            cached = await utils.alookup_answer(question, embedding)
+        if cached is not None:
+            metrics.searches.inc(result='cached')
+            if Configuration.Debug:
+                print(f'Answer served from cache:\n{cached[1]}')
+            yield 'sql', utils.display_sql(cached[0])
+            yield 'done', cached[1]
+            return
+
+        sql = await sql_task
+        yield 'sql', utils.display_sql(sql)
+        db_res = None
+        if not (sql is None or sql.isspace()):
+            params = await utils.run_blocking(utils.generated_sql_params, embedding, sql)
+            db_res = await utils.aexecute_generated(sql, params)
+
+        if db_res is None:
+            metrics.searches.inc(result='no_result')
+            yield 'done', description
+            return
+        yield 'rows', {'columns': db_res[0], 'rows': db_res[1], 'truncated': db_res[2]}
+
+        if stream_description:
+            pieces = []
+            async for piece in utils.adescribe_stream(question, db_res):
+                pieces.append(piece)
+                yield 'description', piece
+            description = ''.join(pieces)
+        else:
+            description = await utils.adescribe(question, db_res)
+        metrics.searches.inc(result='answered')
+        if Configuration.Debug:
+            print(f'Answer:\n{description}')
+        _fire_and_forget(utils.asave_question(question, description, sql, embedding))
+        utils.remember_answer(question, sql, description)
+    except Exception as ex:
+        print(traceback.format_exc())
+        print(f"Failed to answer question \"{question}\", exception: {ex}")
+        metrics.searches.inc(result='failed')
+        _fire_and_forget(utils.asave_question(question, f'Failed due to {ex}'))
+    finally:
+        # On a cache hit, a failure or a client gone, the completion isn't awaited anymore: cancelling closes its
+        # connection (unlike a thread future), and an error it already raised is retrieved so it isn't logged.
+        if sql_task is not None:
+            if sql_task.done():
+                if not sql_task.cancelled():
+                    sql_task.exception()
+            else:
+                sql_task.cancel()
+
+    yield 'done', description
@@ -6,7 +6,7 @@ import utils
 def test_e2e():
     question = "Which repository has most stargazers?"
     sql = utils.question2sql(utils.load_tables_schema(), question)
-    res = utils.execute(sql)
+    res = utils.execute_generated(sql, utils.generated_sql_params(utils.embed_question(question)))
     print(utils.describe(question, res))
 
 
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+import vectors
+
+
+def brute_force_match(keys, matrix, embedding, threshold, count, candidates):
+    """`ReadmeVectorIndex.match` computed in float32 over the whole matrix."""
+    matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    scores = matrix @ (embedding / np.linalg.norm(embedding))
+    by_repo = {}
+    for row in np.argsort(-scores)[:count * candidates]:
+        if scores[row] > threshold:
+            by_repo.setdefault(int(keys[row][0]), []).append(float(scores[row]))
+    ranked = sorted(by_repo.items(), key=lambda item: -sum(item[1]) / len(item[1]))[:count]
+    return [(repo_id, sum(s) / len(s)) for repo_id, s in ranked]
+
+
+def test_readme_vector_index():
+    rng = np.random.default_rng(0)
+    dimensions, repos, chunks = 1536, 5000, 4
+    matrix = rng.normal(size=(repos * chunks, dimensions)).astype(np.float32)
+    keys = [(repo_id, chunk_id) for repo_id in range(repos) for chunk_id in range(chunks)]
+    # Repos whose chunks are near the query, at distinct distances so the ranking is stable.
+    embedding = rng.normal(size=dimensions).astype(np.float32)
+    for i, repo_id in enumerate(rng.choice(repos, 30, replace=False)):
+        rows = slice(repo_id * chunks, (repo_id + 1) * chunks)
+        matrix[rows] = embedding + (0.2 + 0.03 * i) * rng.normal(size=(chunks, dimensions))
+
+    index = vectors.ReadmeVectorIndex(os.path.join(tempfile.mkdtemp(), 'readme.f16'), dimensions)
+    try:
+        for start in range(0, repos, 500):
+            index.replace({repo_id: [(chunk_id, matrix[repo_id * chunks + chunk_id]) for chunk_id in range(chunks)]
+                           for repo_id in range(start, start + 500)})
+        assert len(index) == repos * chunks
+
+        tracemalloc.start()
+        try:
+            matches = index.match(embedding, 0.4, 20, 10)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # One float32 block of 4096 rows is 24 MiB, far below the 120 MiB of the whole matrix.
+        assert peak < 32 * 2 ** 20, peak
+
+        expected = brute_force_match(keys, matrix, embedding, 0.4, 20, 10)
+        found = list(dict.fromkeys((repo_id, similarity) for repo_id, _, similarity in matches))
+        assert [repo_id for repo_id, _ in found] == [repo_id for repo_id, _ in expected]
+        assert np.allclose([s for _, s in found], [s for _, s in expected], atol=1e-2)
+    finally:
+        index.close()
@@ -1,229 +1,451 @@
+import asyncio
+import atexit
+import functools
 import hashlib
 import json
-import os
-import tempfile
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-import openai
 import psycopg2
+from psycopg2.extras import execute_values
 import requests
+import tiktoken
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from config import Configuration
-from langchain_community.embeddings import AzureOpenAIEmbeddings
-from langchain.text_splitter import CharacterTextSplitter
-from langchain_community.document_loaders import UnstructuredMarkdownLoader
+import cache
+import chunking
+import db
+import embeddings
+import metrics
+import migrations
+import ratelimit
 
-openai.api_type = Configuration.OpenaiApiType
-openai.api_base = Configuration.OpenaiAzureEndpoint.strip()
-openai.api_version = Configuration.OpenaiApiVersion
-openai.api_key = Configuration.OpenaiApiKey.strip()
 
-embedding_function = AzureOpenAIEmbeddings(azure_endpoint=Configuration.OpenaiAzureEndpoint,
-                                           azure_deployment="text-embedding-ada-002",
-                                           api_key=Configuration.OpenaiApiKey)
+# openai and langchain take seconds to import, they are loaded on the first model call instead of at startup.
+@functools.lru_cache(maxsize=1)
+def get_openai():
+    import openai
+    openai.api_type = Configuration.OpenaiApiType
+    openai.api_base = Configuration.OpenaiAzureEndpoint.strip()
+    openai.api_version = Configuration.OpenaiApiVersion
+    openai.api_key = Configuration.OpenaiApiKey.strip()
+    return openai
+
+
+@functools.lru_cache(maxsize=1)
+def get_embedding_function():
+    from langchain_community.embeddings import AzureOpenAIEmbeddings
+    return AzureOpenAIEmbeddings(azure_endpoint=Configuration.OpenaiAzureEndpoint,
+                                 azure_deployment="text-embedding-ada-002",
+                                 api_key=Configuration.OpenaiApiKey)
+
+
+def chunk_readme(repo, readme):
+    return chunking.chunk_markdown(readme, Configuration.ReadmeChunkTokens, Configuration.ReadmeChunkOverlap)
+
+
+embedder = embeddings.EmbeddingBatcher(
+    lambda texts: get_embedding_function().embed_documents(texts, chunk_size=Configuration.EmbeddingBatchSize),
+    max_batch=Configuration.EmbeddingBatchSize,
+    max_request_tokens=Configuration.EmbeddingMaxRequestTokens,
+    window=Configuration.EmbeddingWindow,
+    concurrency=Configuration.EmbeddingConcurrency,
+    cache_size=Configuration.EmbeddingCacheSize)
+
+
+def embed_texts(texts):
+    if not texts:
+        return []
+    return embedder.embed(texts)
 
 
 def get_chunked_embeddings(repo, readme):
-    repo_name = repo['full_name']
-    folder = os.path.join(tempfile.gettempdir(), repo_name)
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-    path = os.path.join(folder, 'readme.md')
-    with open(path, 'w') as f:
-        f.write(readme)
-
-    loader = UnstructuredMarkdownLoader(path)
-    documents = loader.load()
-    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=50)
-    docs = text_splitter.split_documents(documents)
-    texts = [_.page_content for _ in docs]
-    os.remove(path)
-    return zip(texts, embedding_function.embed_documents(texts, chunk_size=1000))
+    texts = chunk_readme(repo, readme)
+    return zip(texts, embed_texts(texts))
 
 
-def get_db():
+# Runs the sql completion of a threaded search next to its embedding, and the blocking calls of the async server.
+io_executor = ThreadPoolExecutor(Configuration.IoWorkers)
+
+
+async def run_blocking(fn, *args):
+    """Await blocking work (psycopg2 has no asyncio support) run on `io_executor`."""
+    return await asyncio.get_running_loop().run_in_executor(io_executor, functools.partial(fn, *args))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def connect_db():
     conn = psycopg2.connect(user=Configuration.DbUser,
                             password=Configuration.DbPassword,
                             host=Configuration.DbHost,
-                            port=5432,
-                            database="githubmeta",
-                            sslmode="require")
+                            port=Configuration.DbPort,
+                            database=Configuration.DbName,
+                            sslmode=Configuration.DbSslMode)
     return conn
 
 
+def get_pool():
+    """The process wide connection pool, created on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = db.ConnectionPool(connect_db,
+                                          min_size=Configuration.DbPoolMinSize,
+                                          max_size=Configuration.DbPoolMaxSize,
+                                          timeout=Configuration.DbPoolTimeout,
+                                          max_idle=Configuration.DbPoolMaxIdle,
+                                          check_interval=Configuration.DbPoolCheckInterval)
+    return _pool
+
+
+def get_db():
+    return get_pool().getconn()
+
+
 def close_db(conn):
-    conn.close()
+    get_pool().putconn(conn)
 
 
 def init_db():
+    """Bring the database schema up to date, see `migrations.migrate`."""
     conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('CREATE EXTENSION IF NOT EXISTS "vector";')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS questions (id SERIAL PRIMARY KEY, text TEXT, result TEXT);''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS repos  
-                        (
-                            id INTEGER PRIMARY KEY, 
-                            name TEXT, 
-                            full_name TEXT, 
-                            owner_id INTEGER, 
-                            owner_login TEXT, 
-                            owner_type TEXT, 
-                            html_url TEXT,
-                            description TEXT, 
-                            created_at TEXT, 
-                            updated_at TEXT, 
-                            pushed_at TEXT, 
-                            clone_url TEXT, 
-                            size INTEGER, 
-                            stargazers_count INTEGER, 
-                            watchers_count INTEGER, 
-                            language TEXT, 
-                            has_issues BOOLEAN, 
-                            has_projects BOOLEAN,
-                            has_downloads BOOLEAN, 
-                            has_wiki BOOLEAN, 
-                            has_pages BOOLEAN, 
-                            has_discussions BOOLEAN, 
-                            forks_count INTEGER,
-                            archived BOOLEAN, 
-                            disabled BOOLEAN, 
-                            open_issues_count INTEGER, 
-                            license TEXT, 
-                            allow_forking BOOLEAN, 
-                            is_template BOOLEAN, 
-                            topics TEXT, 
-                            visibility TEXT, 
-                            forks INTEGER, 
-                            open_issues INTEGER, 
-                            watchers INTEGER, 
-                            default_branch TEXT, 
-                            score REAL, 
-                            readme_md5 TEXT, 
-                            extra TEXT
-                        )
-                        ''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS repo_readme_vector  
-                        (
-                            repo_id INTEGER,
-                            chunk_id INTEGER,
-                            text TEXT,
-                            embedding vector(1536)
-                        )
-                        ''')
-    cursor.execute("""DO $$
-                    BEGIN
-                        IF NOT EXISTS (
-                            SELECT 1
-                            FROM   pg_constraint 
-                            WHERE  conname = 'repo_chunk_unique'
-                        )
-                        THEN
-                            ALTER TABLE repo_readme_vector
-                            ADD CONSTRAINT repo_chunk_unique UNIQUE (repo_id, chunk_id);
-                        END IF;
-                    END
-                    $$;
-                    """)
-    cursor.execute("""
-        create or replace function match_readme (
-          query_embedding vector(1536),
-          match_threshold float,
-          match_count int
-        )
-        returns table (
-          repo_id int,
-          text text,
-          similarity float
-        )
-        language sql stable
-        as $$
-          select
-            repo_readme_vector.repo_id,
-            string_agg(repo_readme_vector.text, ' ') AS text,
-            1 - avg(repo_readme_vector.embedding <=> query_embedding) AS similarity
-          from repo_readme_vector
-          where repo_readme_vector.embedding <=> query_embedding < 1 - match_threshold
-          group by repo_readme_vector.repo_id
-          order by avg(repo_readme_vector.embedding <=> query_embedding)
-          limit match_count;
-        $$;
-        """)
-    conn.commit()
-    close_db(conn)
-
-
-def save_question(question, result):
+    try:
+        migrated = migrations.migrate(conn)
+    finally:
+        close_db(conn)
+    if migrated:
+        invalidate_schema_cache()
+
+
+# The in process readme vector index (vectors.py), loaded in the background on first use when
+# ReadmeVectorsInProcess, then refreshed with the chunks changed since every ReadmeVectorsRefreshInterval.
+_readme_vectors = {'index': None, 'since': None, 'refreshed_at': float('-inf'), 'refreshing': False}
+_readme_vectors_lock = threading.Lock()
+
+
+def get_readme_vectors():
+    """The in process readme vector index, None when disabled or until its first load is done."""
+    if not Configuration.ReadmeVectorsInProcess:
+        return None
+    with _readme_vectors_lock:
+        refresh = (not _readme_vectors['refreshing'] and
+                   time.monotonic() - _readme_vectors['refreshed_at'] >= Configuration.ReadmeVectorsRefreshInterval)
+        if refresh:
+            _readme_vectors['refreshing'] = True
+    if refresh:
+        threading.Thread(target=refresh_readme_vectors, name='readme-vectors', daemon=True).start()
+    return _readme_vectors['index']
+
+
+def loaded_readme_vectors():
+    """The in process readme vector index if it was loaded, without starting a load or refresh."""
+    return _readme_vectors['index']
+
+
+def refresh_readme_vectors():
+    """Load the readme chunks changed since the last refresh into the in process index, all of them at first."""
+    import vectors
+    index, since = _readme_vectors['index'], _readme_vectors['since']
+    target = index
+    if target is None:
+        # One file per process: workers killed before their exit hook ran leave theirs behind.
+        vectors.remove_stale(Configuration.ReadmeVectorsDir)
+        target = vectors.ReadmeVectorIndex(vectors.index_path(Configuration.ReadmeVectorsDir))
+        atexit.register(target.close)
+    try:
+        with metrics.timer('ingest', 'readme_vectors_refresh'):
+            conn = get_db()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT now();")
+                started = cursor.fetchone()[0]
+                cursor = conn.cursor(name='readme_vectors')
+                cursor.itersize = Configuration.DbWriteBatchSize
+                if since is None:
+                    cursor.execute("SELECT repo_id, chunk_id, embedding::text FROM repo_readme_vector "
+                                   "ORDER BY repo_id, chunk_id;")
+                else:
+                    # The margin covers the writes that committed after this snapshot but started before it.
+                    cursor.execute("SELECT repo_id, chunk_id, embedding::text FROM repo_readme_vector "
+                                   "WHERE repo_id IN (SELECT repo_id FROM repo_readme_vector "
+                                   "                  WHERE updated_at > %s - interval '5 minutes') "
+                                   "ORDER BY repo_id, chunk_id;", (since,))
+                batch = {}
+                for repo_id, chunk_id, embedding in cursor:
+                    if repo_id not in batch and len(batch) >= Configuration.IngestBatchSize:
+                        target.replace(batch)
+                        batch = {}
+                    batch.setdefault(repo_id, []).append((chunk_id, vectors.parse_vector(embedding)))
+                if batch:
+                    target.replace(batch)
+                cursor.close()
+                conn.commit()
+            finally:
+                close_db(conn)
+        _readme_vectors.update(index=target, since=started)
+        print(f"Readme vectors refreshed: {len(target)} chunks")
+    except Exception as e:
+        traceback.print_exc()
+        print(f"Error refreshing readme vectors: {e}")
+    finally:
+        with _readme_vectors_lock:
+            _readme_vectors.update(refreshing=False, refreshed_at=time.monotonic())
+
+
+def save_question(question, result, sql=None, embedding=None):
+    """
+    Record an answered question. Only questions saved with their sql and embedding are reused by
+    `lookup_answer`, failed answers should be saved without them.
+    """
+    with metrics.timer('search', 'save_question'):
+        conn = get_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO questions (text, result, sql, embedding) VALUES (%s, %s, %s, %s::vector);",
+                           (question, result, sql, vector_literal(embedding) if embedding is not None else None))
+            conn.commit()
+        finally:
+            close_db(conn)
+
+
+async def asave_question(question, result, sql=None, embedding=None):
+    await run_blocking(save_question, question, result, sql, embedding)
+
+
+answer_cache = cache.LRUCache(maxsize=Configuration.AnswerCacheSize, ttl=Configuration.AnswerCacheTtl)
+_last_ingest = {'at': 0.0, 'checked_at': float('-inf')}
+_last_ingest_lock = threading.Lock()
+
+
+def _last_ingest_fresh():
+    return time.monotonic() - _last_ingest['checked_at'] < Configuration.AnswerIngestCheckInterval
+
+
+def answers_valid_after():
+    """
+    The time of the last ingest write by any instance, read from the database at most every
+    `AnswerIngestCheckInterval` seconds. The in process answers are dropped when it moves.
+    """
+    with _last_ingest_lock:
+        if _last_ingest_fresh():
+            return _last_ingest['at']
+        _last_ingest['checked_at'] = time.monotonic()
     conn = get_db()
     try:
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO questions (text, result) VALUES (%s, %s);", (question, result))
-        conn.commit()
+        cursor.execute("SELECT extract(epoch FROM last_loaded_at) FROM ingest_state;")
+        row = cursor.fetchone()
+        conn.rollback()
     finally:
         close_db(conn)
+    at = float(row[0]) if row is not None else 0.0
+    with _last_ingest_lock:
+        if at > _last_ingest['at']:
+            _last_ingest['at'] = at
+            answer_cache.clear()
+        return _last_ingest['at']
+
+
+def normalize_question(question):
+    return ' '.join(question.lower().split())
+
+
+def lookup_answer(question, embedding=None):
+    """
+    Return the (sql, description) previously generated for this question, or for a question whose
+    embedding is at least `AnswerCacheThreshold` cosine similar when the embedding is given.
+    Answers older than `AnswerCacheTtl` seconds or than the last ingest are not reused.
+    """
+    valid_after = answers_valid_after()
+    key = normalize_question(question)
+    answer = answer_cache.get(key)
+    if answer is not None or embedding is None:
+        return answer
+
+    since = max(valid_after, time.time() - Configuration.AnswerCacheTtl)
+    with metrics.timer('search', 'answer_lookup'):
+        conn = get_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT sql, result, 1 - (embedding <=> %(embedding)s::vector) FROM questions"
+                           " WHERE embedding IS NOT NULL AND sql IS NOT NULL AND created_at > to_timestamp(%(since)s)"
+                           " ORDER BY embedding <=> %(embedding)s::vector LIMIT 1;",
+                           {'embedding': vector_literal(embedding), 'since': since})
+            row = cursor.fetchone()
+        finally:
+            close_db(conn)
+    if row is None or row[2] < Configuration.AnswerCacheThreshold:
+        return None
+    answer = (row[0], row[1])
+    answer_cache.set(key, answer)
+    return answer
+
+
+async def alookup_answer(question, embedding=None):
+    if embedding is None and _last_ingest_fresh():
+        return lookup_answer(question)  # In memory only
+    return await run_blocking(lookup_answer, question, embedding)
+
+
+def remember_answer(question, sql, description):
+    answer_cache.set(normalize_question(question), (sql, description))
+
+
+def invalidate_answers():
+    """
+    Drop the in process answers once new repos have been loaded, the load itself is recorded in `ingest_state`
+    by `load_repos_into_db` for the other instances.
+    """
+    with _last_ingest_lock:
+        _last_ingest['checked_at'] = float('-inf')
+        answer_cache.clear()
+
+
+REPO_COLUMNS = ['id', 'name', 'full_name', 'owner_id', 'owner_login', 'owner_type', 'html_url',
+                'description', 'created_at', 'updated_at', 'pushed_at', 'clone_url', 'size',
+                'stargazers_count', 'watchers_count', 'language', 'has_issues', 'has_projects',
+                'has_downloads', 'has_wiki', 'has_pages', 'has_discussions', 'forks_count',
+                'archived', 'disabled', 'open_issues_count', 'license', 'allow_forking',
+                'is_template', 'topics', 'visibility', 'forks', 'open_issues',
+                'watchers', 'default_branch', 'score', 'readme_md5', 'extra']
+README_VECTOR_COLUMNS = ['repo_id', 'chunk_id', 'text', 'embedding']
+SUMMARY_COLUMNS = ['name', 'full_name', 'owner_login', 'license', 'description', 'created_at', 'updated_at',
+                   'stargazers_count', 'forks_count', 'open_issues_count', 'topics', 'extra']
+
+
+def repo_row(data):
+    """The values of `REPO_COLUMNS` for a repo fetched from GitHub."""
+    return (data['id'], data['name'], data['full_name'], data['owner']['id'], data['owner']['login'],
+            data['owner']['type'], data['html_url'],
+            ' '.join(data['description'].split()[:50]) if data['description'] is not None else None,
+            data['created_at'],
+            data['updated_at'],
+            data['pushed_at'], data['clone_url'], data['size'], data['stargazers_count'],
+            data['watchers_count'],
+            data['language'], data['has_issues'], data['has_projects'], data['has_downloads'],
+            data['has_wiki'],
+            data['has_pages'], data['has_discussions'], data['forks_count'], data['archived'],
+            data['disabled'],
+            data['open_issues_count'],
+            data['license']['key'] if data['license'] is not None else None,
+            data['allow_forking'],
+            data['is_template'],
+            ', '.join(data['topics']), data['visibility'], data['forks'], data['open_issues'],
+            data['watchers'],
+            data['default_branch'],
+            data['score'] if 'score' in data is not None else None,
+            data['readme_md5'],
+            data['extra'])
 
 
 def load_repo_into_db(data):
+    load_repos_into_db([data])
+
+
+def load_repos_into_db(repos):
+    """
+    Upsert a batch of repos and their readme chunks with one statement per table, in one transaction.
+    Repos with a new readme (or no readme anymore) also lose the chunks beyond their current chunk count.
+    """
+    # A statement can't upsert the same row twice, keep the last version of each repo.
+    repos = list({data['id']: data for data in repos}.values())
+    chunk_rows = []
+    chunk_counts = []
+    chunk_vectors = {}
+    for data in repos:
+        if data['readme'] is not None:
+            chunks = list(data['readme'])
+            chunk_rows.extend((data['id'], idx, text, vector_literal(embedding))
+                              for idx, (text, embedding) in enumerate(chunks))
+            chunk_counts.append((data['id'], len(chunks)))
+            chunk_vectors[data['id']] = [(idx, embedding) for idx, (_, embedding) in enumerate(chunks)]
+        elif data['readme_md5'] is None:
+            chunk_counts.append((data['id'], 0))
+            chunk_vectors[data['id']] = []
+    repo_rows = [repo_row(data) for data in repos]
+    summary_rows = [summary_row(dict(zip(REPO_COLUMNS, row))) for row in repo_rows]
     conn = get_db()
     try:
         cursor = conn.cursor()
-        repo_col_list = ['id', 'name', 'full_name', 'owner_id', 'owner_login', 'owner_type', 'html_url',
-                         'description', 'created_at', 'updated_at', 'pushed_at', 'clone_url', 'size',
-                         'stargazers_count', 'watchers_count', 'language', 'has_issues', 'has_projects',
-                         'has_downloads', 'has_wiki', 'has_pages', 'has_discussions', 'forks_count',
-                         'archived', 'disabled', 'open_issues_count', 'license', 'allow_forking',
-                         'is_template', 'topics', 'visibility', 'forks', 'open_issues',
-                         'watchers', 'default_branch', 'score', 'readme_md5', 'extra']
-        cursor.execute(
-            "INSERT INTO repos "
-            f"({','.join(repo_col_list)})"
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, "
-            "%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
-            "ON CONFLICT (id) DO UPDATE SET "
-            f"{','.join([_ + ' = ' + 'excluded.' + _ for _ in repo_col_list])};",
-            (data['id'], data['name'], data['full_name'], data['owner']['id'], data['owner']['login'],
-             data['owner']['type'], data['html_url'],
-             ' '.join(data['description'].split()[:50]) if data['description'] is not None else None,
-             data['created_at'],
-             data['updated_at'],
-             data['pushed_at'], data['clone_url'], data['size'], data['stargazers_count'],
-             data['watchers_count'],
-             data['language'], data['has_issues'], data['has_projects'], data['has_downloads'],
-             data['has_wiki'],
-             data['has_pages'], data['has_discussions'], data['forks_count'], data['archived'],
-             data['disabled'],
-             data['open_issues_count'],
-             data['license']['key'] if data['license'] is not None else None,
-             data['allow_forking'],
-             data['is_template'],
-             ', '.join(data['topics']), data['visibility'], data['forks'], data['open_issues'],
-             data['watchers'],
-             data['default_branch'],
-             data['score'] if 'score' in data is not None else None,
-             data['readme_md5'],
-             data['extra']))
-        embeddings = data['readme']
-        if embeddings is not None:
-            for idx, embed in enumerate(embeddings):
-                repo_readme_vector_col_list = ['repo_id', 'chunk_id', 'text', 'embedding']
-                cursor.execute("INSERT INTO repo_readme_vector "
-                               f"({','.join(repo_readme_vector_col_list)})"
-                               "VALUES (%s, %s, %s, %s)"
-                               "ON CONFLICT (repo_id, chunk_id) DO UPDATE SET "
-                               f"{','.join([_ + ' = ' + 'excluded.' + _ for _ in repo_readme_vector_col_list])};",
-                               (data['id'], idx, embed[0], embed[1]))
+        execute_values(cursor,
+                       f"INSERT INTO repos ({','.join(REPO_COLUMNS)}) VALUES %s "
+                       "ON CONFLICT (id) DO UPDATE SET "
+                       f"{','.join([_ + ' = ' + 'excluded.' + _ for _ in REPO_COLUMNS])};",
+                       repo_rows,
+                       page_size=Configuration.DbWriteBatchSize)
+        _upsert_summaries(cursor, summary_rows)
+        if chunk_counts:
+            execute_values(cursor,
+                           "DELETE FROM repo_readme_vector USING (VALUES %s) AS latest (repo_id, chunk_count) "
+                           "WHERE repo_readme_vector.repo_id = latest.repo_id "
+                           "AND repo_readme_vector.chunk_id >= latest.chunk_count;",
+                           chunk_counts,
+                           page_size=Configuration.DbWriteBatchSize)
+        if chunk_rows:
+            execute_values(cursor,
+                           f"INSERT INTO repo_readme_vector ({','.join(README_VECTOR_COLUMNS)}) VALUES %s "
+                           "ON CONFLICT (repo_id, chunk_id) DO UPDATE SET "
+                           f"{','.join([_ + ' = ' + 'excluded.' + _ for _ in README_VECTOR_COLUMNS])}, "
+                           "updated_at = now();",
+                           chunk_rows,
+                           template="(%s, %s, %s, %s::vector)",
+                           page_size=Configuration.DbWriteBatchSize)
+        # Last, to hold the row lock only until the commit.
+        cursor.execute("INSERT INTO ingest_state (last_loaded_at) VALUES (now()) "
+                       "ON CONFLICT (id) DO UPDATE SET last_loaded_at = excluded.last_loaded_at;")
         conn.commit()
     finally:
         close_db(conn)
+    for key, _, _ in summary_rows:
+        summary_cache.pop(key)
+    index = _readme_vectors['index']
+    if index is not None and chunk_vectors:
+        index.replace(chunk_vectors)
+
+
+# Bookkeeping tables, not shown to the model in the schema prompt.
+INTERNAL_TABLES = ['ingest_jobs', 'ingest_state', 'repo_summaries', 'schema_version', 'schema_objects']
 
+_schema_cache = {'schema': None, 'loaded_at': 0.0}
+_schema_lock = threading.Lock()
 
-def load_tables_schema():
-    """Load the table schema as return the schema in text format."""
+
+def load_tables_schema(refresh=False):
+    """
+    Load the table schema as return the schema in text format.
+    The schema is cached for `SchemaCacheTtl` seconds and invalidated whenever `init_db` runs.
+    """
+    with _schema_lock:
+        expired = time.monotonic() - _schema_cache['loaded_at'] > Configuration.SchemaCacheTtl
+        if refresh or expired or _schema_cache['schema'] is None:
+            with metrics.timer('search', 'schema'):
+                schema = _query_tables_schema()
+            if schema is not None:
+                _schema_cache['schema'] = schema
+                _schema_cache['loaded_at'] = time.monotonic()
+        return _schema_cache['schema']
+
+
+def invalidate_schema_cache():
+    with _schema_lock:
+        _schema_cache['schema'] = None
+        _schema_cache['loaded_at'] = 0.0
+
+
+def _query_tables_schema():
     conn = get_db()
     try:
         c = conn.cursor()
         c.execute("SELECT table_name, column_name, data_type"
                   " FROM information_schema.columns"
-                  f" WHERE table_schema = 'public';")
+                  " WHERE table_schema = 'public' AND table_name <> ALL(%s);",
+                  (INTERNAL_TABLES,))
         tables = c.fetchall()
         table_schemas = {}
         for row in tables:
@@ -242,26 +464,46 @@ def load_tables_schema():
         close_db(conn)
 
 
-def question2sql(schemas, question):
-    prompt = ("Postgresql tables schemas:\n\n```{}```\n\n\n"
-              "If you want to search the readme for answer, call function `match_readme`."
-              "This function will do the context comparison and return the readme content relevant to the question. Which means you don't need to compare the question with the readme content in other parts of the query."
-              "You can expect the result of the function call is (repo_id, text, similarity), in which the texts are already similar to the question so you don't need to compare to confirm its similarity. "
-              "For example, you call ```match_readme([0.1, 0.2])``` to get the repo_id, text similar to embedding [0.1, 0.2]."
-              "Example for using the function to get relevant readme content: ```SELECT * FROM <match_readme> AS a JOIN repos ON repos.id = a.repo_id ORDER BY a.similarity DESC LIMIT 10```"
-              "You can union the result from the function and the result from querying `repos` to generate a comprehensive result."
-              "Usually, you don't need to match all the columns in the table, just the relevant columns is enough. Generally, one in description, topics or readme matches is enough."
-              "\n\nPlease generate a query to answer question: ```{}```\n\n"
-              "The embedding for this question is ```{}```\n\n"
-              "Start the query with `<` and end the query with `>`, example: `<SELECT * FROM repos LIMIT 1>`.\n"
-              "And please only get the relevant columns from the tables, usually less than 10 columns is preferred.\n"
-              "And please always shorten the description (column `description`) in the result to within 50 words.\n"
-              "And please always order by stargazers_count DESC and limit 20.\n"
-              "And please just use commonly used operators unless it's necessary to use some special operators.\n"
-              "And please always use '%>' operator instead of 'LIKE' to do word matching as there are , example: `WHERE description <% 'databases'`.\n"
-              "And please avoid 'SELECT * FROM xxx' and please be selective as to the columns in the intermediate result and final result.\n"
-              "Example query for finding repos that are relevant to `databases`, this kind of question requires semantic comparing and you need to use match_readme and '%>':\n"
-              """```<WITH readme_repos AS (
+def embed_question(question):
+    with metrics.timer('search', 'embedding'):
+        return embedder.embed([question])[0]
+
+
+async def aembed_question(question):
+    with metrics.timer('search', 'embedding'):
+        return await asyncio.wrap_future(embedder.submit([question])[0])
+
+
+def vector_literal(embedding):
+    return '[' + ','.join(map(str, embedding)) + ']'
+
+
+def count_tokens(text):
+    return len(tiktoken.get_encoding("cl100k_base").encode(text))
+
+
+SQL_PROMPT_HEAD = ("Postgresql tables schemas:\n\n```{}```\n\n\n"
+                   "If you want to search the readme for answer, call function `match_readme`."
+                   "This function will do the context comparison and return the readme content relevant to the question. Which means you don't need to compare the question with the readme content in other parts of the query."
+                   "You can expect the result of the function call is (repo_id, text, similarity), in which the texts are already similar to the question so you don't need to compare to confirm its similarity. "
+                   "For example, you call ```match_readme([0.1, 0.2])``` to get the repo_id, text similar to embedding [0.1, 0.2]."
+                   "Example for using the function to get relevant readme content: ```SELECT * FROM <match_readme> AS a JOIN repos ON repos.id = a.repo_id ORDER BY a.similarity DESC LIMIT 10```"
+                   "You can union the result from the function and the result from querying `repos` to generate a comprehensive result."
+                   "Usually, you don't need to match all the columns in the table, just the relevant columns is enough. Generally, one in description, topics or readme matches is enough.")
+
+SQL_PROMPT_QUESTION = ("\n\nPlease generate a query to answer question: ```{}```\n\n"
+                       "The embedding for this question is ```[0.1, 0.2, 0.3]```\n\n")
+
+SQL_PROMPT_TAIL = ("Start the query with `<` and end the query with `>`, example: `<SELECT * FROM repos LIMIT 1>`.\n"
+                   "And please only get the relevant columns from the tables, usually less than 10 columns is preferred.\n"
+                   "And please always shorten the description (column `description`) in the result to within 50 words.\n"
+                   "And please always order by stargazers_count DESC and limit 20.\n"
+                   "And please just use commonly used operators unless it's necessary to use some special operators.\n"
+                   "And please always use '%>' operator instead of 'LIKE' to do word matching as there are trigram indexes for it, example: `WHERE description %> 'databases'`.\n"
+                   "And please use `topic_list @> ARRAY['databases']` to match an exact topic and `search_vector @@ websearch_to_tsquery('english', 'graph databases')` to match several keywords in description and topics.\n"
+                   "And please avoid 'SELECT * FROM xxx' and please be selective as to the columns in the intermediate result and final result.\n"
+                   "Example query for finding repos that are relevant to `databases`, this kind of question requires semantic comparing and you need to use match_readme and '%>':\n"
+                   """```<WITH readme_repos AS (
                     SELECT repo_id as id FROM match_readme([0.1, 0.2, 0.3])
                 ),
                 description_match AS (
@@ -291,14 +533,35 @@ def question2sql(schemas, question):
                 ORDER BY stargazers_count DESC
                 LIMIT 20
                 >```\n\n"""
-              "Example query for finding repos `with most stars`, this kind of question does not require semantic comparing:\n"
-              """```<SELECT name, full_name, language, stargazers_count, html_url, topics FROM repos 
+                   "Example query for finding repos `with most stars`, this kind of question does not require semantic comparing:\n"
+                   """```<SELECT name, full_name, language, stargazers_count, html_url, topics FROM repos 
                 ORDER BY stargazers_count DESC
                 LIMIT 20>```\n\n"""
-              "If you are not sure how to generate the query, just respond `<>`.\n\n"
-              "Query: ".format(schemas, question, [0.1, 0.2, 0.3]))
-    print(prompt)
-    response = openai.ChatCompletion.create(
+                   "If you are not sure how to generate the query, just respond `<>`.\n\n"
+                   "Query: ")
+
+
+@functools.lru_cache(maxsize=8)
+def sql_prompt_prefix(schemas):
+    """The static part of the question2sql prompt for the given schemas, with its token count."""
+    prefix = SQL_PROMPT_HEAD.format(schemas)
+    return prefix, count_tokens(prefix)
+
+
+@functools.lru_cache(maxsize=1)
+def sql_prompt_tail_tokens():
+    return count_tokens(SQL_PROMPT_TAIL)
+
+
+def _sql_request(schemas, question):
+    prefix, prefix_tokens = sql_prompt_prefix(schemas)
+    question_part = SQL_PROMPT_QUESTION.format(question)
+    prompt = prefix + question_part + SQL_PROMPT_TAIL
+    prompt_tokens = prefix_tokens + count_tokens(question_part) + sql_prompt_tail_tokens()
+    metrics.openai_tokens.inc(prompt_tokens, call='question2sql', kind='prompt')
+    if Configuration.Debug:
+        print(f"question2sql prompt ({prompt_tokens} tokens):\n{prompt}")
+    return dict(
         engine=Configuration.OpenaiModel,
         messages=[{"role": "system",
                    "content":
@@ -312,19 +575,77 @@ def question2sql(schemas, question):
         presence_penalty=0,
         stop=["#", ";"]
     )
-    msg = response.choices[0].message.content
-    print(f'Msg from model: \n{msg}\n')
-    embedding_array = embedding_function.embed_documents([question], chunk_size=1000)[0]
-    sql = msg.strip('`').strip('\n').strip('<').strip('>').replace('match_readme([0.1, 0.2, 0.3])', f"public.match_readme('{embedding_array}', 0.4, 20)")
+
+
+MATCH_README_CALL = "public.match_readme(%(question_embedding)s::vector, 0.4, 20)"
+# The same lookup with the nearest chunks found in process, see `generated_sql_params`.
+MATCH_README_CHUNKS_CALL = ("public.match_readme_chunks(%(readme_repo_ids)s::int[], %(readme_chunk_ids)s::int[], "
+                            "%(readme_similarities)s::float[])")
+
+
+def _parse_sql(msg):
+    if Configuration.Debug:
+        print(f'Msg from model: \n{msg}\n')
+    sql = (msg.strip('`').strip('\n').strip('<').strip('>')
+           .replace('%', '%%')
+           .replace('match_readme([0.1, 0.2, 0.3])',
+                    MATCH_README_CHUNKS_CALL if get_readme_vectors() is not None else MATCH_README_CALL))
     print(f"Generated query: {sql}")
     return sql
 
 
-def execute(query):
+def question2sql(schemas, question):
+    """
+    Generate the sql answering the question. The returned sql calls `match_readme` with the question
+    embedding as a bound parameter, execute it with `execute_generated(sql, generated_sql_params(embedding))`.
+    """
+    request = _sql_request(schemas, question)
+    with metrics.timer('search', 'question2sql'):
+        response = get_openai().ChatCompletion.create(**request)
+    _count_completion(response, 'question2sql')
+    return _parse_sql(response.choices[0].message.content)
+
+
+async def aquestion2sql(schemas, question):
+    request = _sql_request(schemas, question)
+    with metrics.timer('search', 'question2sql'):
+        response = await get_openai().ChatCompletion.acreate(**request)
+    _count_completion(response, 'question2sql')
+    return _parse_sql(response.choices[0].message.content)
+
+
+def _count_completion(response, call):
+    usage = response.get('usage')
+    if usage is not None:
+        metrics.openai_tokens.inc(usage['completion_tokens'], call=call, kind='completion')
+
+
+def generated_sql_params(embedding, sql=None):
+    """The parameters of the generated sql, including the readme chunks nearest to the question when it needs them."""
+    params = {'question_embedding': vector_literal(embedding)}
+    if sql is None or MATCH_README_CHUNKS_CALL in sql:
+        index = get_readme_vectors()
+        matches = []
+        if index is not None:
+            with metrics.timer('search', 'readme_vectors'):
+                matches = index.match(embedding, 0.4, 20, Configuration.MatchReadmeCandidates)
+        params.update(readme_repo_ids=[m[0] for m in matches], readme_chunk_ids=[m[1] for m in matches],
+                      readme_similarities=[m[2] for m in matches])
+    return params
+
+
+def display_sql(sql):
+    """The generated sql as a user would read it, without the parameter escaping."""
+    return (sql.replace('%(question_embedding)s', "'<question embedding>'")
+            .replace(MATCH_README_CHUNKS_CALL, "public.match_readme_chunks('<nearest readme chunks>')")
+            .replace('%%', '%'))
+
+
+def execute(query, params=None):
     conn = get_db()
     try:
         cur = conn.cursor()
-        cur.execute(query)
+        cur.execute(query, params)
         column_names = [desc[0] for desc in cur.description]
         res = cur.fetchall()
         return column_names, res
@@ -332,64 +653,259 @@ def execute(query):
         close_db(conn)
 
 
-def describe(question, rows):
+class QueryRejected(Exception):
+    """A generated query whose plan is too expensive to run."""
+
+
+def _plan(cursor, query, params):
+    cursor.execute("EXPLAIN (FORMAT JSON) " + query, params)
+    return cursor.fetchone()[0][0]['Plan']
+
+
+def execute_generated(query, params=None):
+    """
+    Run model generated sql within limits: a read only transaction with a `GeneratedSqlTimeout` statement
+    timeout, a plan cost check, and a server side cursor that stops fetching after `GeneratedSqlMaxRows` rows
+    or `GeneratedSqlMaxBytes` bytes of values.
+    Queries expected to return more rows than that without a LIMIT are wrapped in one so the planner can pick
+    a plan for the first rows, queries still estimated above `GeneratedSqlMaxCost` raise `QueryRejected`.
+    Returns (column names, rows, truncated), truncated says why rows were left out, None when none were.
+    """
+    with metrics.timer('search', 'sql'):
+        return _execute_generated(query, params)
+
+
+def _execute_generated(query, params):
+    max_rows = Configuration.GeneratedSqlMaxRows
+    query = query.strip().rstrip(';')
+    conn = get_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SET TRANSACTION READ ONLY;")
+        cursor.execute("SET LOCAL statement_timeout = %s;", (int(Configuration.GeneratedSqlTimeout * 1000),))
+        plan = _plan(cursor, query, params)
+        if plan['Node Type'] != 'Limit' and plan['Plan Rows'] > max_rows:
+            query = f"SELECT * FROM ({query}) AS generated LIMIT {max_rows + 1}"
+            plan = _plan(cursor, query, params)
+        if plan['Total Cost'] > Configuration.GeneratedSqlMaxCost:
+            raise QueryRejected(f"Query too expensive, estimated cost {plan['Total Cost']:.0f} is over "
+                                f"{Configuration.GeneratedSqlMaxCost:.0f}")
+
+        named = conn.cursor(name='generated_sql')
+        named.itersize = Configuration.GeneratedSqlFetchSize
+        try:
+            named.execute(query, params)
+            rows, size, truncated = [], 0, None
+            for row in named:
+                if len(rows) >= max_rows:
+                    truncated = f"only the first {max_rows} rows are kept"
+                    break
+                size += sum(len(str(value)) for value in row)
+                if rows and size > Configuration.GeneratedSqlMaxBytes:
+                    truncated = f"only the first {len(rows)} rows fit in {Configuration.GeneratedSqlMaxBytes} bytes"
+                    break
+                rows.append(row)
+            column_names = [desc[0] for desc in named.description]
+        finally:
+            named.close()
+        if truncated:
+            print(f"Generated query result truncated: {truncated}")
+        return column_names, rows, truncated
+    finally:
+        close_db(conn)
+
+
+async def aexecute_generated(query, params=None):
+    return await run_blocking(execute_generated, query, params)
+
+
+def _cell(value, max_chars):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        value = round(value, 3)
+    text = ' '.join(str(value).split()).replace('|', '\\|')
+    if len(text) > max_chars:
+        text = text[:max_chars - 1] + '…'
+    return text
+
+
+def _table_line(values, max_chars):
+    return '| ' + ' | '.join(_cell(value, max_chars) for value in values) + ' |'
+
+
+def result_table(columns, rows, max_chars=None):
+    """The query result as a markdown table, values longer than `max_chars` characters are cut."""
+    max_chars = max_chars or Configuration.DescribeCellChars
+    lines = [_table_line(columns, max_chars), '|' + ' --- |' * len(columns)]
+    lines.extend(_table_line(row, max_chars) for row in rows)
+    return '\n'.join(lines)
+
+
+def prompt_table(columns, rows, max_tokens):
+    """The markdown table of the first rows that fit in `max_tokens` tokens, and the number of rows kept."""
+    max_chars = Configuration.DescribePromptCellChars
+    lines = [result_table(columns, [], max_chars)]
+    tokens = count_tokens(lines[0])
+    for row in rows:
+        line = _table_line(row, max_chars)
+        tokens += count_tokens(line) + 1
+        if tokens > max_tokens:
+            break
+        lines.append(line)
+    return '\n'.join(lines), len(lines) - 1
+
+
+def _describe_request(question, rows, stream=False):
+    """
+    The arguments of the describe chat completion. The result table is shown to the user as is, the model
+    only writes the explanation, from as many rows as fit in `DescribePromptTokens` tokens.
+    """
+    table, kept = prompt_table(rows[0], rows[1], Configuration.DescribePromptTokens)
+    notes = []
+    if kept < len(rows[1]):
+        notes.append(f"Only the first {kept} of the {len(rows[1])} rows are given here.")
+    if len(rows) > 2 and rows[2]:
+        notes.append(f"The result itself is truncated, {rows[2]}, mention that more results exist.")
     prompt = ("Here is a question to answer: ```{}```\n"
-              "And here is the query result that contains the answer:\n"
-              "Column names: ```{}```\n"
-              "Rows: ```{}```\n\n"
-              "Please answer the question with the above information, and use abbreviation when necessary "
-              "to limit the response in 3000 words."
-              "Your description should focus on the question and the answer to the question."
-              "Please follow the following requirements:"
-              "1. Generate the description in markdown format."
-              "2. The first part is the query result in table format if query result is not empty, don't omit any row among the rows."
-              "3. The second part is a brief explanation of the table content, you can skip this part for abbreviation."
-              "4. Don't mention the query, focus on question and result.\n\n"
-              "Description: ").format(question, rows[0], rows[1])
-    print(prompt)
-    response = openai.ChatCompletion.create(engine=Configuration.OpenaiModel,
-                                            messages=[{"role": "system",
-                                                       "content": "You are an assistant that answer questions for people."},
-                                                      {"role": "user", "content": prompt}],
-                                            temperature=0,
-                                            max_tokens=4000,
-                                            top_p=1,
-                                            frequency_penalty=0,
-                                            presence_penalty=0,
-                                            stop=["#", ";"])
+              "The query result that contains the answer is already shown to the user as this table:\n"
+              "{}\n{}\n\n"
+              "Write a brief explanation of the table content that answers the question, in markdown, "
+              "in at most {} words. Don't repeat the table and don't mention the query, "
+              "focus on question and result.\n\n"
+              "Explanation: ").format(question, table, ' '.join(notes), Configuration.DescribeMaxWords)
+    prompt_tokens = count_tokens(prompt)
+    metrics.openai_tokens.inc(prompt_tokens, call='describe', kind='prompt')
+    if Configuration.Debug:
+        print(f"describe prompt ({prompt_tokens} tokens):\n{prompt}")
+    return dict(engine=Configuration.OpenaiModel,
+                messages=[{"role": "system",
+                           "content": "You are an assistant that answer questions for people."},
+                          {"role": "user", "content": prompt}],
+                temperature=0,
+                max_tokens=Configuration.DescribeMaxTokens,
+                top_p=1,
+                frequency_penalty=0,
+                presence_penalty=0,
+                stop=["#", ";"],
+                stream=stream)
+
+
+def _chunk_content(chunk):
+    if not chunk.choices:
+        return None
+    return chunk.choices[0].delta.get('content')
+
+
+def _table_part(rows):
+    return result_table(rows[0], rows[1]) + '\n\n'
+
+
+def describe(question, rows):
+    """The result table followed by the model's explanation of it."""
+    with metrics.timer('search', 'describe'):
+        response = get_openai().ChatCompletion.create(**_describe_request(question, rows))
+    _count_completion(response, 'describe')
     msg = response.choices[0].message.content
-    return msg
+    return _table_part(rows) + msg
 
 
-def load_repo(repo_name):
+def describe_stream(question, rows):
+    """Same as `describe`, but yields the table at once then the explanation piece by piece as it is generated."""
+    yield _table_part(rows)
+    with metrics.timer('search', 'describe'):
+        for chunk in get_openai().ChatCompletion.create(**_describe_request(question, rows, stream=True)):
+            content = _chunk_content(chunk)
+            if content:
+                # Streamed chunks carry no usage, each one is a token.
+                metrics.openai_tokens.inc(call='describe', kind='completion')
+                yield content
+
+
+async def adescribe(question, rows):
+    with metrics.timer('search', 'describe'):
+        response = await get_openai().ChatCompletion.acreate(**_describe_request(question, rows))
+    _count_completion(response, 'describe')
+    return _table_part(rows) + response.choices[0].message.content
+
+
+async def adescribe_stream(question, rows):
+    yield _table_part(rows)
+    with metrics.timer('search', 'describe'):
+        async for chunk in await get_openai().ChatCompletion.acreate(**_describe_request(question, rows, stream=True)):
+            content = _chunk_content(chunk)
+            if content:
+                metrics.openai_tokens.inc(call='describe', kind='completion')
+                yield content
+
+
+def stored_repo_versions(repo_names):
+    """The `pushed_at`, `updated_at`, `readme_md5` and `extra` last loaded for each repo, by full name."""
+    _, rows = execute("SELECT full_name, pushed_at, updated_at, readme_md5, extra FROM repos WHERE full_name = ANY(%s)",
+                      (list(repo_names),))
+    return {row[0]: {'pushed_at': row[1], 'updated_at': row[2], 'readme_md5': row[3], 'extra': row[4]}
+            for row in rows}
+
+
+def fetch_repo(repo_name, versions=None):
+    """
+    Fetch a repo, its extra info and its readme from GitHub. When the readme changed since it was last
+    loaded its text is kept in `readme_text` to be chunked and embedded into `readme`.
+
+    `versions` are the stored repo versions from `stored_repo_versions`, they let unchanged repos skip
+    the expensive work. The reason is recorded in `skip_reason`:
+    'unchanged': nothing changed since the last load, the repo doesn't need to be written at all.
+    'not_pushed': only metadata changed, the stored extra info and readme are kept.
+    'readme_unchanged': the readme has the same md5, it is not embedded again.
+    """
     repo = get_repo(repo_name)
     if repo is None:
         print(f"Didn't get repo {repo_name}")
-        return
+        return None
+    repo['readme'] = None
+    repo['readme_text'] = None
+    repo['skip_reason'] = None
+    if versions is None:
+        versions = stored_repo_versions([repo_name])
+    stored = versions.get(repo_name)
+    if stored is not None and Configuration.IngestIncremental and stored['pushed_at'] == repo['pushed_at']:
+        # Readme, languages and contributors only change with a push.
+        repo['skip_reason'] = 'unchanged' if stored['updated_at'] == repo['updated_at'] else 'not_pushed'
+        repo['readme_md5'] = stored['readme_md5']
+        repo['extra'] = stored['extra']
+        return repo
+
     extra = get_extra_info(repo_name)
     readme = get_readme(repo_name, repo['default_branch'])
-    embeddings = None
     if readme is not None:
         readme_md5 = hashlib.md5(readme.encode(encoding='UTF-8', errors='strict')).hexdigest()
         repo['readme_md5'] = readme_md5
-        repo['readme'] = None
-        _, rows = execute(f"SELECT COUNT(*) FROM repos WHERE \"full_name\" = '{repo_name}' AND \"readme_md5\" = '{readme_md5}'")
-        if rows[0][0] == 0:
-            # make the readme more compact.
-            readme += ' '.join(readme.split())
-            embeddings = get_chunked_embeddings(repo, readme)
-            repo['readme'] = embeddings
+        if stored is not None and stored['readme_md5'] == readme_md5:
+            repo['skip_reason'] = 'readme_unchanged'
+        else:
+            repo['readme_text'] = readme
     else:
         repo['readme_md5'] = None
-        repo['readme'] = None
 
     repo["extra"] = json.dumps(extra)
+    return repo
+
+
+def load_repo(repo_name):
+    repo = fetch_repo(repo_name)
+    if repo is None:
+        return
+    if repo['skip_reason'] == 'unchanged':
+        print(f'skipped repo: {repo_name}, unchanged')
+        return
+    if repo['readme_text'] is not None:
+        repo['readme'] = get_chunked_embeddings(repo, repo['readme_text'])
     load_repo_into_db(repo)
     print(f'loaded repo: {repo_name}')
 
 
 def get_repo(repo_name):
-    url = f"https://api.github.com/repos/{repo_name}"
+    url = f"{Configuration.GithubApiUrl}/repos/{repo_name}"
     resp = get(url)
     if resp is None:
         return None
@@ -397,18 +913,59 @@ def get_repo(repo_name):
 
 
 def get_readme(repo_name, default_branch):
-    url = f"https://raw.githubusercontent.com/{repo_name}/{default_branch}/README.md"
-    return get(url)
+    """
+    The readme text, None when the repo has none (404). Other failures raise, so that the ingest job is retried
+    instead of the stored chunks being deleted.
+    """
+    url = f"{Configuration.GithubRawUrl}/{repo_name}/{default_branch}/README.md"
+    return get(url, raise_errors=True)
+
 
+github_rate_limiter = ratelimit.TokenBucket(Configuration.GithubRequestsPerSecond,
+                                            Configuration.GithubRequestsBurst,
+                                            reserve=Configuration.GithubRateLimitReserve)
 
-def get(url):
+
+github_session = requests.Session()
+github_session.auth = HTTPBasicAuth(Configuration.GithubUsername, Configuration.GithubToken)
+for prefix in ("https://", "http://"):
+    github_session.mount(prefix, HTTPAdapter(pool_connections=4, pool_maxsize=Configuration.HttpPoolSize))
+http_cache = cache.DiskResponseCache(Configuration.HttpCacheDir, max_bytes=Configuration.HttpCacheMaxBytes,
+                                     max_age=Configuration.HttpCacheMaxAge)
+
+
+def get(url, raise_errors=False):
+    """
+    GET a GitHub url through the shared keep-alive session. Responses are cached on disk and revalidated
+    with `If-None-Match`/`If-Modified-Since`, a `304 Not Modified` is served from the cache.
+    Returns None on an error status, with `raise_errors` only on a 404 and other errors raise `HTTPError`.
+    """
     headers = {'Accept': 'application/vnd.github+json'}
-    response = requests.get(url,
-                            auth=HTTPBasicAuth(Configuration.GithubUsername, Configuration.GithubToken),
-                            headers=headers)
+    cached = http_cache.get(url)
+    if cached is not None:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    is_api = url.startswith(Configuration.GithubApiUrl + "/")
+    if is_api:
+        github_rate_limiter.acquire()
+    response = github_session.get(url, headers=headers, timeout=Configuration.HttpTimeout)
+    if is_api:
+        github_rate_limiter.update(response.headers)
+    if response.status_code == 304 and cached is not None:
+        http_cache.hits += 1
+        return cached['body']
+    http_cache.misses += 1
     if not response.ok:
         print(response.text)
+        if raise_errors and response.status_code != 404:
+            response.raise_for_status()
         return None
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if etag or last_modified:
+        http_cache.set(url, etag, last_modified, response.text)
     return response.text
 
 
@@ -422,28 +979,88 @@ def summarize_repo(repo_name):
     Recent activities: number of PRs and issues closed last week/month.
     A quality rate.
     """
-    query = f"SELECT * FROM repos WHERE full_name = '{repo_name}'"
-    _, data = execute(query)
+    summary, _ = get_summaries([repo_name])[repo_name]
+    return json.loads(summary)
+
+
+def repo_summary(repo):
+    """The summary shown by the extension, from the `SUMMARY_COLUMNS` values of a repo."""
+    extra = json.loads(repo['extra']) if repo['extra'] is not None else {}
+    return {"Name": repo['name'],
+            "Full name": repo['full_name'],
+            "Owner": repo['owner_login'],
+            "License": repo['license'],
+            "Description": repo['description'],
+            "Created at": repo['created_at'],
+            "Most recent up at": repo['updated_at'],
+            "Stars": repo['stargazers_count'],
+            "Forks": repo['forks_count'],
+            "Main languages": ','.join(extra.get('top-languages', [])),
+            "Open issues count": repo['open_issues_count'],
+            "Topics": repo['topics'],
+            "Main contributors": ','.join(extra.get('top-contributors', []))}
+
+
+def _etag(body):
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+def summary_row(repo):
+    """The (key, summary json, etag) row materialized for a repo."""
+    summary = json.dumps(repo_summary(repo))
+    return repo['full_name'].lower(), summary, _etag(summary)
+
+
+def _upsert_summaries(cursor, rows):
+    if rows:
+        execute_values(cursor,
+                       "INSERT INTO repo_summaries (full_name, summary, etag) VALUES %s "
+                       "ON CONFLICT (full_name) DO UPDATE SET summary = excluded.summary, etag = excluded.etag;",
+                       rows,
+                       page_size=Configuration.DbWriteBatchSize)
+
+
+summary_cache = cache.LRUCache(maxsize=Configuration.SummaryCacheSize, ttl=Configuration.SummaryCacheTtl)
+MISSING_SUMMARY = ('{}', _etag('{}'))
+
+
+def get_summaries(repo_names):
+    """
+    The (summary json, etag) of each repo by requested name, `MISSING_SUMMARY` for repos never loaded.
+    Summaries are served from `summary_cache`, then read from `repo_summaries` with one query. Repos loaded
+    before summaries were materialized are summarized from `repos` once and materialized.
+    """
     res = {}
-    if data is not None:
-        repo = data[0]
-        if repo[-1] is None:
-            extra = {'top-languages': [], 'top-contributors': []}
+    missing = {}  # key -> requested names
+    for name in repo_names:
+        cached = summary_cache.get(name.lower())
+        if cached is not None:
+            res[name] = cached
         else:
-            extra = json.loads(repo[-1])
-        res["Name"] = repo[1]
-        res["Full name"] = repo[2]
-        res["Owner"] = repo[4]
-        res["License"] = repo[26]
-        res["Description"] = repo[7]
-        res["Created at"] = repo[8]
-        res["Most recent up at"] = repo[9]
-        res["Stars"] = repo[13]
-        res["Forks"] = repo[22]
-        res["Main languages"] = f"{','.join(extra['top-languages'])}"
-        res["Open issues count"] = repo[25]
-        res["Topics"] = repo[29]
-        res["Main contributors"] = f"{','.join(extra['top-contributors'])}"
+            missing.setdefault(name.lower(), []).append(name)
+    if not missing:
+        return res
+
+    conn = get_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT full_name, summary, etag FROM repo_summaries WHERE full_name = ANY(%s);",
+                       (list(missing),))
+        found = {key: (summary, etag) for key, summary, etag in cursor.fetchall()}
+        unsummarized = [key for key in missing if key not in found]
+        if unsummarized:
+            cursor.execute(f"SELECT {','.join(SUMMARY_COLUMNS)} FROM repos WHERE lower(full_name) = ANY(%s);",
+                           (unsummarized,))
+            rows = [summary_row(dict(zip(SUMMARY_COLUMNS, row))) for row in cursor.fetchall()]
+            _upsert_summaries(cursor, rows)
+            conn.commit()
+            found.update({key: (summary, etag) for key, summary, etag in rows})
+    finally:
+        close_db(conn)
+    for key, names in missing.items():
+        summary = found.get(key, MISSING_SUMMARY)
+        summary_cache.set(key, summary)
+        res.update({name: summary for name in names})
     return res
 
 
@@ -455,8 +1072,8 @@ def summarize_user(user_name):
 
 def get_extra_info(repo_name):
     extra = {}
-    languages = json.loads(get(f"https://api.github.com/repos/{repo_name}/languages"))
-    contributors = json.loads(get(f"https://api.github.com/repos/{repo_name}/contributors"))
+    languages = json.loads(get(f"{Configuration.GithubApiUrl}/repos/{repo_name}/languages"))
+    contributors = json.loads(get(f"{Configuration.GithubApiUrl}/repos/{repo_name}/contributors"))
     extra['top-languages'] = [k for k, v in languages.items()]
     extra['top-contributors'] = [item['login'] for item in contributors]
     return extra
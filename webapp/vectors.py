@@ -0,0 +1,175 @@
+import os
+import re
+import threading
+
+import numpy as np
+
+
+def parse_vector(text):
+    """A pgvector text value ('[0.1,0.2,...]') as a float32 array."""
+    return np.fromstring(text.strip('[]'), dtype=np.float32, sep=',')
+
+
+def index_path(folder):
+    """The index file of this process in `folder`."""
+    return os.path.join(folder, f'readme-{os.getpid()}.f16')
+
+
+def remove_stale(folder):
+    """Remove the index files left in `folder` by processes that are gone, e.g. killed workers."""
+    if not os.path.isdir(folder):
+        return
+    for name in os.listdir(folder):
+        match = re.fullmatch(r'readme-(\d+)\.f16(\.tmp)?', name)
+        if match is None or int(match.group(1)) == os.getpid():
+            continue
+        try:
+            os.kill(int(match.group(1)), 0)
+            continue  # Still running
+        except ProcessLookupError:
+            pass
+        except OSError:
+            continue  # Running as another user
+        try:
+            os.remove(os.path.join(folder, name))
+        except OSError:
+            pass
+
+
+class ReadmeVectorIndex:
+    """
+    In-process nearest neighbour search over the readme chunk embeddings, so semantic lookups don't need a
+    database round trip. Embeddings are normalized and stored as float16 in a file that is memory mapped read
+    only, half the size of float32 and paged by the OS instead of living on the Python heap. Queries are scored
+    in batches against float32 blocks of `block_rows` rows, which bound the memory of a search (about 25 MB with
+    the default 4096 rows of 1536 dimensions).
+
+    The file is append only: replacing the chunks of a repo appends the new ones and tombstones the old ones,
+    and it is rewritten once tombstones reach `compact_ratio` of the rows. Searches work on a snapshot and are
+    not blocked by updates.
+    """
+
+    def __init__(self, path, dimensions=1536, block_rows=4096, compact_ratio=0.3):
+        self._path = path
+        self._dimensions = dimensions
+        self._block_rows = block_rows
+        self._compact_ratio = compact_ratio
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._keys = np.empty((0, 2), dtype=np.int32)  # (repo_id, chunk_id) of each row
+        self._alive = np.empty(0, dtype=bool)
+        self._rows_by_repo = {}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'wb').close()
+
+    def __len__(self):
+        return int(self._alive.sum())
+
+    def close(self):
+        """Remove the file, searches already running keep the mapping they read from."""
+        with self._lock:
+            self._matrix = None
+            self._keys = np.empty((0, 2), dtype=np.int32)
+            self._alive = np.empty(0, dtype=bool)
+            self._rows_by_repo = {}
+            for path in [self._path, self._path + '.tmp']:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def replace(self, chunks_by_repo):
+        """Set the chunks of the repos, {repo_id: [(chunk_id, embedding)]}, an empty list removes a repo."""
+        keys, vectors = [], []
+        for repo_id, chunks in chunks_by_repo.items():
+            for chunk_id, embedding in chunks:
+                keys.append((repo_id, chunk_id))
+                vectors.append(embedding)
+        if vectors:
+            matrix = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self._dimensions)
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            alive = self._alive.copy()
+            for repo_id in chunks_by_repo:
+                alive[self._rows_by_repo.pop(repo_id, [])] = False
+            start = len(alive)
+            if vectors:
+                with open(self._path, 'ab') as f:
+                    f.write(matrix.astype(np.float16).tobytes())
+                self._keys = np.concatenate([self._keys, np.asarray(keys, dtype=np.int32)])
+                alive = np.concatenate([alive, np.ones(len(keys), dtype=bool)])
+                for row, (repo_id, _) in enumerate(keys, start):
+                    self._rows_by_repo.setdefault(repo_id, []).append(row)
+            self._alive = alive
+            self._remap()
+            if len(alive) and (~alive).sum() >= self._compact_ratio * len(alive):
+                self._compact()
+                self._remap()
+
+    def _remap(self):
+        rows = os.path.getsize(self._path) // (2 * self._dimensions)
+        self._matrix = np.memmap(self._path, dtype=np.float16, mode='r', shape=(rows, self._dimensions)) \
+            if rows else None
+
+    def _compact(self):
+        rows = np.flatnonzero(self._alive)
+        tmp = self._path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for start in range(0, len(rows), self._block_rows):
+                f.write(np.ascontiguousarray(self._matrix[rows[start:start + self._block_rows]]).tobytes())
+        # Searches still reading the old file keep it open until they are done.
+        os.replace(tmp, self._path)
+        self._keys = self._keys[rows]
+        self._alive = np.ones(len(rows), dtype=bool)
+        self._rows_by_repo = {}
+        for row, repo_id in enumerate(self._keys[:, 0].tolist()):
+            self._rows_by_repo.setdefault(repo_id, []).append(row)
+
+    def search(self, queries, k):
+        """
+        The `k` chunks nearest to each of the (n, dimensions) `queries` by cosine similarity, best first:
+        (keys (n, k, 2) of (repo_id, chunk_id), similarities (n, k)), fewer than `k` when the index is smaller.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self._dimensions)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            matrix, keys, alive = self._matrix, self._keys, self._alive
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        # One float32 buffer per search, the float16 rows are converted into it block by block.
+        buffer = np.empty((0 if matrix is None else min(self._block_rows, len(matrix)), self._dimensions),
+                          dtype=np.float32)
+        for start in range(0, 0 if matrix is None else len(matrix), self._block_rows):
+            block = buffer[:len(matrix[start:start + self._block_rows])]
+            np.copyto(block, matrix[start:start + self._block_rows])
+            scores = queries @ block.T
+            scores[:, ~alive[start:start + len(block)]] = -np.inf
+            rows = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+            best_rows, best_scores = self._top(np.hstack([best_rows, rows]), np.hstack([best_scores, scores]), k)
+        order = np.argsort(-best_scores, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        found = np.isfinite(best_scores).all(axis=0)
+        return keys[best_rows[:, found]], best_scores[:, found]
+
+    @staticmethod
+    def _top(rows, scores, k):
+        if scores.shape[1] <= k:
+            return rows, scores
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        return np.take_along_axis(rows, top, axis=1), np.take_along_axis(scores, top, axis=1)
+
+    def match(self, embedding, threshold, count, candidates=10):
+        """
+        Same as the `match_readme` database function: the `count` repos whose nearest chunks, among the
+        `count * candidates` nearest to the embedding, are the most similar on average, keeping the chunks
+        at least `threshold` similar. Returns [(repo_id, chunk_id, repo similarity)] for every chunk kept.
+        """
+        keys, scores = self.search([embedding], count * candidates)
+        by_repo = {}
+        for (repo_id, chunk_id), score in zip(keys[0].tolist(), scores[0].tolist()):
+            if score > threshold:
+                by_repo.setdefault(repo_id, []).append((chunk_id, score))
+        ranked = sorted(by_repo.items(), key=lambda item: -sum(s for _, s in item[1]) / len(item[1]))[:count]
+        return [(repo_id, chunk_id, sum(s for _, s in chunks) / len(chunks))
+                for repo_id, chunks in ranked for chunk_id, _ in chunks]